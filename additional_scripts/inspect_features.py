@@ -1,6 +1,7 @@
 from collections import defaultdict, Counter
 from utils.paths import get_data_preprocessed_dir
 from utils.helpers import feature2spec_token
+from utils.feature_sidecar import load_matching_sidecar, sidecar_bin_values
 import matplotlib.pyplot as plt
 import argparse
 import numpy as np
@@ -15,9 +16,17 @@ def extract_features(file_path: str):
     :param file_path: path to the preprocessed source file, i.e. the file that includes the features that were extracted
                         during the preprocessing
     :return: a dictionary with the feature names as keys and a list of all feature value occurrences
+    If the columnar sidecar written by preprocess.py exists and matches the file, the values are read from it
+    instead of the text
     """
 
     feature_dict = defaultdict(list)
+    sidecar = load_matching_sidecar(file_path)
+    if sidecar is not None:
+        for feature_name, values in sidecar_bin_values(sidecar).items():
+            feature_dict[feature2spec_token[feature_name]] = values.tolist()
+        return feature_dict
+
     with open(file_path, "r", encoding="utf-8") as prep_corp:
         for line in prep_corp:
             splitted_line = line.strip().split()
@@ -0,0 +1,99 @@
+"""
+Preprocess the shards of the corpus with workers on one or many hosts that share the repository directory (or at
+least the job directory and the data directories).
+
+Publish the job (the coordinator), creating the shard manifest first if --lines is given:
+    python additional_scripts/shard_job_runner.py publish --config configs/[config_file].yaml --lines 100000
+        [--phases train] [--job-dir DIR] [--preprocess-args "--tokenizer spacy --workers 4"] [--local-workers N]
+Start any number of workers, on any host:
+    python additional_scripts/shard_job_runner.py work --job-dir DIR
+Show the progress:
+    python additional_scripts/shard_job_runner.py status --job-dir DIR
+
+The workers claim the shards through lock files in the job directory, a worker that dies loses its shards to the
+others after --stale-after seconds. When all shards are done, one worker merges them into data_preprocessed/.
+The SQLite feature cache cannot be shared over a network file system: every host uses a cache on its local disk
+(in the temp directory), unless --preprocess-args sets --no-feature-cache or a --feature-cache on a local disk.
+"""
+
+import argparse
+import shlex
+from multiprocessing import Process
+from utils.helpers import load_yaml
+from utils.paths import get_data_shard_dir
+from utils.shard_manifest import create_shard_manifest, load_shard_manifest, get_phase_shard_names
+from utils.shard_jobs import ShardJobDirectory, run_worker, MERGE_TASK
+
+
+def get_default_job_dir(lang, features):
+    return get_data_shard_dir(lang) / "jobs" / "_".join(features)
+
+
+def publish_job(config_path, phases, job_dir=None, lines=None, preprocess_args=""):
+    config = load_yaml(config_path)
+    lang, features = config["lang"].lower(), sorted(config["features"])
+    if lines:
+        for phase in phases:
+            create_shard_manifest(lang, int(lines), phase)
+    manifest = load_shard_manifest(lang)
+    phase_shards = {phase: get_phase_shard_names(manifest, phase) for phase in phases}
+    if not all(phase_shards.values()):
+        raise ValueError("The shard manifest has no shards for %s, create them with --lines"
+                         % ", ".join(phase for phase, names in phase_shards.items() if not names))
+
+    job_dir = job_dir or get_default_job_dir(lang, features)
+    job = {"lang": lang, "features": features, "phases": phase_shards,
+           "shards": [name for phase in phases for name in phase_shards[phase]],
+           "command": ["preprocess.py", "--config", str(config_path)] + shlex.split(preprocess_args)}
+    ShardJobDirectory(job_dir).publish(job)
+    print("Published %d shards in %s" % (len(job["shards"]), str(job_dir)))
+    return job_dir
+
+
+def print_status(job_dir):
+    jobs = ShardJobDirectory(job_dir)
+    for state, shards in jobs.status().items():
+        print("%s: %d %s" % (state, len(shards), " ".join(shards)))
+    print("merged: %s" % ("yes" if jobs.is_done(MERGE_TASK) else "failed" if jobs.is_failed(MERGE_TASK) else "no"))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest="command")
+    publish_parser = subparsers.add_parser("publish", help="publish the shards of a preprocessing config as a job")
+    publish_parser.add_argument("--config", required=True, help="yaml config file for preprocess.py")
+    publish_parser.add_argument("--phases", nargs="+", default=["train"], help="the splits to shard, default train")
+    publish_parser.add_argument("--lines", required=False, help="create the shard manifest with this many lines per "
+                                                                "shard, else use the existing manifest")
+    publish_parser.add_argument("--job-dir", required=False, help="shared job directory, default "
+                                                                  "data_shards/[lang]/jobs/[features]")
+    publish_parser.add_argument("--preprocess-args", required=False, default="",
+                                help="further arguments of preprocess.py, e.g. \"--tokenizer spacy --workers 4\"")
+    publish_parser.add_argument("--local-workers", type=int, required=False, default=0,
+                                help="start this many workers on this host and wait for them")
+    for name, help_text in [("work", "claim and preprocess shards until the job is done"),
+                            ("status", "show the state of the shards")]:
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--job-dir", required=True, help="shared job directory")
+    for sub in [publish_parser, subparsers.choices["work"]]:
+        sub.add_argument("--heartbeat", type=float, required=False, default=30,
+                         help="seconds between the heartbeats of a worker, default 30")
+        sub.add_argument("--stale-after", type=float, required=False, default=600,
+                         help="seconds without heartbeat after which a claim is taken over, default 600")
+    args = vars(arg_parser.parse_args())
+
+    if args["command"] == "publish":
+        JOB_DIR = publish_job(args["config"], args["phases"], args["job_dir"], args["lines"],
+                              args["preprocess_args"])
+        workers = [Process(target=run_worker, args=(JOB_DIR, None, args["heartbeat"], args["stale_after"]))
+                   for _ in range(args["local_workers"])]
+        [w.start() for w in workers]
+        [w.join() for w in workers]
+        if workers:
+            print_status(JOB_DIR)
+    elif args["command"] == "work":
+        run_worker(args["job_dir"], heartbeat_interval=args["heartbeat"], stale_after=args["stale_after"])
+    elif args["command"] == "status":
+        print_status(args["job_dir"])
+    else:
+        arg_parser.print_help()
@@ -1,39 +1,77 @@
+import os
+import numpy as np
 from utils.paths import get_data_shard_dir, get_data_filepath
-from utils.helpers import load_tokenizer, load_yaml
+from utils.helpers import load_yaml
+from utils.feature_sidecar import get_sidecar_path, load_sidecar, write_sidecar
+from utils.preprocessing_journal import get_partial_path
+from utils.shard_manifest import load_shard_manifest, get_phase_shard_names, count_lines, append_file
 import argparse
 
 
+def merge_shard_sidecars(shard_src_paths, merged_src_path):
+    """ Concatenate the feature sidecars of the preprocessed shards, the line offsets continue over the shards """
+    sidecars = [load_sidecar(get_sidecar_path(path)) for path in shard_src_paths]
+    line_offsets = [np.zeros(1, dtype=np.int64)]
+    for sidecar in sidecars:
+        if sidecar["features"] != sidecars[0]["features"]:
+            raise ValueError("The shards have sidecars with different features")
+        line_offsets.append(sidecar["line_offsets"][1:] + line_offsets[-1][-1])
+    write_sidecar(get_sidecar_path(merged_src_path), sidecars[0]["features"],
+                  np.concatenate([sidecar["exact"] for sidecar in sidecars]),
+                  np.concatenate([sidecar["bins"] for sidecar in sidecars]), np.concatenate(line_offsets))
+
+
 def merge_preprocessed_shards(phase: str, lang: str, shards: list, features: list):
     """
     :param phase: the data set split that the shards to put together belong to, 'train', 'test' or 'valid'
     :param lang: language
-    :param shards: list of the ids of the shards that should be merged together in the same order as in the list
+    :param shards: list of the ids of the shards that should be merged together in the same order as in the list,
+        an empty list for a phase that was preprocessed as a single shard named after the phase (test, valid)
     :param features: list of the features that were extracted
+    The shard files are concatenated with kernel copies. The line counts of every shard (src, tgt and the number of
+    lines in the shard manifest) and of the merged files are checked before the merged files replace older ones.
     """
 
     preprocessed_shard_dir = get_data_shard_dir(lang) / "preprocessed" / "_".join(features)
+    manifest = load_shard_manifest(lang)
+    shard_names = [phase + "_" + str(shard_id) for shard_id in shards] if shards else [phase]
 
+    shard_lines = []
+    for shard_name in shard_names:
+        n_src = count_lines(preprocessed_shard_dir / (shard_name + ".src"))
+        n_tgt = count_lines(preprocessed_shard_dir / (shard_name + ".tgt"))
+        expected = manifest[shard_name]["lines"] if shard_name in manifest else n_src
+        if not n_src == n_tgt == expected:
+            raise ValueError("Shard %s has %d source lines and %d target lines, expected %d"
+                             % (shard_name, n_src, n_tgt, expected))
+        shard_lines.append(n_src)
+
+    merged_paths = {}
     for suffix in ["src", "tgt"]:
         preprocessed_data = get_data_filepath(features, phase, suffix, lang)
-        with open(preprocessed_data, "w", encoding="utf-8") as out_file:
-
-            # for the test and valid data only move the preprocessed data to the target directory
-            if len(shards) == 0:
-                shard_name = phase + "." + suffix
-                with open(preprocessed_shard_dir / shard_name, "r", encoding="utf-8") as shard:
-                    for line in shard:
-                        out_file.write(line)
-
-            # for the train data add all preprocessed files into one file
-            else:
-                for shard_id in shards:
-                    shard_name = phase + "_" + str(shard_id) + "." + suffix
-                    with open(preprocessed_shard_dir / shard_name, "r", encoding="utf-8") as shard:
-                        for line in shard:
-                            # skip empty lines and end of shard files
-                            if line == "\n":
-                                continue
-                            out_file.write(line)
+        merged_paths[suffix] = preprocessed_data
+        with open(get_partial_path(preprocessed_data), "wb", buffering=0) as out_file:
+            for shard_name in shard_names:
+                append_file(out_file, preprocessed_shard_dir / (shard_name + "." + suffix))
+        n_merged = count_lines(get_partial_path(preprocessed_data))
+        if n_merged != sum(shard_lines):
+            raise ValueError("%s has %d lines, the shards have %d lines" % (str(get_partial_path(preprocessed_data)),
+                                                                           n_merged, sum(shard_lines)))
+
+    shard_src_paths = [preprocessed_shard_dir / (shard_name + ".src") for shard_name in shard_names]
+    has_sidecar = [get_sidecar_path(path).exists() for path in shard_src_paths]
+    if any(has_sidecar) and not all(has_sidecar):
+        raise ValueError("Only some of the shards of %s have a feature sidecar" % phase)
+
+    for suffix, preprocessed_data in merged_paths.items():
+        os.replace(get_partial_path(preprocessed_data), preprocessed_data)
+    if all(has_sidecar):
+        merge_shard_sidecars(shard_src_paths, merged_paths["src"])
+    elif get_sidecar_path(merged_paths["src"]).exists():
+        # the sidecar of an earlier merge does not belong to the merged text
+        os.remove(get_sidecar_path(merged_paths["src"]))
+    print("Merged %d shards of %s, %d lines, into %s" % (len(shard_names), phase, sum(shard_lines),
+                                                         str(merged_paths["src"].parent)))
 
 
 if __name__=="__main__":
@@ -48,7 +86,9 @@ if __name__=="__main__":
 
     for phase in PHASES:
         phase_key = phase + "_ids"
-        FILE_IDS = config[phase_key]
+        if phase_key in config:
+            FILE_IDS = config[phase_key]
+        else:
+            # all shards of the phase in the shard manifest
+            FILE_IDS = [name[len(phase) + 1:] for name in get_phase_shard_names(load_shard_manifest(LANG), phase)]
         merge_preprocessed_shards(phase, LANG, FILE_IDS, FEATURES_REQUESTED)
-
-
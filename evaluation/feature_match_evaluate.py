@@ -17,10 +17,11 @@ The code here:
 """
 import re
 import numpy as np
-from utils.helpers import yield_lines_in_parallel
-from utils.feature_extraction import feature_bins_bundle_sentence
+from utils.helpers import yield_batches_in_parallel
+from utils.feature_extraction import feature_bins_bundle_corpus
 from utils.prepare_word_embeddings_frequency_ranks import load_ranks
-from utils.feature_bin_preparation import create_bins
+from utils.feature_bin_preparation import get_feature_bins
+from utils.feature_sidecar import load_matching_sidecar, sidecar_bin_values, strip_control_tokens
 
 feature2spec_token = {"dependency": "MaxDep", "frequency": "FreqRank", "length": "Length", "levenshtein": "Leven"}
 spec_token2feature = {v: k for k, v in feature2spec_token.items()}
@@ -57,38 +58,66 @@ def analyze_f_match(orig_features, system_features):
     return by_mismatch
 
 
-def parse_file_pair_return_analysis(orig_src_path, system_out_path, requested_features, lang):
+def parse_file_pair_return_analysis(orig_src_path, system_out_path, requested_features, lang, batch_size=256,
+                                    sidecar_path=None, plain_source=False):
     """ orig_src_path is a str full path to the original source file with prepended features
     system_out_path is a str full path to the rewritten text generated by the model
+    batch_size is the number of sentence pairs that are parsed together with spacy's nlp.pipe
+    sidecar_path is the path to the columnar feature sidecar of the original source file, default: the
+    [name].features.npz next to orig_src_path. If it exists and matches the lines of orig_src_path, the requested
+    bins are read from it instead of the text
+    plain_source: the original source sentences have no control tokens (task feature_control_translation), the bins
+    are read from the sidecar
     """
     # load the feature bins and the frequency ranks
-    feature_bins = create_bins()
+    feature_bins = get_feature_bins()
 
     frequency_ranks = load_ranks(lang)
 
+    # a sidecar that does not match the source file (stale or truncated) is ignored
+    sidecar = load_matching_sidecar(orig_src_path, sidecar_path)
+    orig_bins_sidecar = None
+    if sidecar is not None:
+        # the sidecar can hold more features than requested, e.g. the one of the plain source corpus
+        orig_bins_sidecar = {feature2spec_token[f]: values for f, values in sidecar_bin_values(sidecar).items()
+                             if f in requested_features}
+        n_control_tokens = 0 if plain_source else len(sidecar["features"])
+    elif plain_source:
+        raise FileNotFoundError("The source sentences have no control tokens and there is no feature sidecar that "
+                                "matches %s" % str(orig_src_path))
+
     feature_matching = {feature2spec_token[f]: {"match": 0, "mismatch": []} for f in requested_features}
     sentence_pair_counter = 0
     print("... Evaluating feature bin match")
     # open the files and iterate over lines/sentences
-    for src_sent, tgt_sent in yield_lines_in_parallel([orig_src_path, system_out_path], strict=True):
-        sentence_pair_counter += 1
-        # first remove the prepended feature tokens from the src sentence
-        f_vals_bin_orig, src_sent = remove_features_from_str(src_sent)
-
-        # calculate the features between the src and system_out
-        f_vals_bin_gen, f_vals_exact = feature_bins_bundle_sentence(src_sent, tgt_sent, lang, requested_features,
-                                                                    feature_bins, frequency_ranks)
-
-        # change the feature names to abbreviated versions and round the GEN bins to 2 decimals
-        f_vals_bin_gen = {feature2spec_token[f]: round(v, 2) for f, v in f_vals_bin_gen.items()}
-
-        # compare the intended and actual features
-        if f_vals_bin_orig:
-            sent_feat_match = analyze_f_match(f_vals_bin_orig, f_vals_bin_gen)
-            for _f in sent_feat_match["match"]:
-                feature_matching[_f]["match"] += 1
-            for _misf, _v in sent_feat_match["mismatch"].items():
-                feature_matching[_misf]["mismatch"].append(_v)
+    for src_batch, tgt_batch in yield_batches_in_parallel([orig_src_path, system_out_path], batch_size, strict=True):
+        first_line = sentence_pair_counter
+        sentence_pair_counter += len(src_batch)
+        # first remove the prepended feature tokens from the src sentences
+        if orig_bins_sidecar is not None:
+            f_vals_bin_orig_batch = [{f: float(values[i]) for f, values in orig_bins_sidecar.items()}
+                                     for i in range(first_line, sentence_pair_counter)]
+            src_batch = [strip_control_tokens(src_sent, n_control_tokens) for src_sent in src_batch]
+        else:
+            f_vals_bin_orig_batch, src_batch = zip(*[remove_features_from_str(src_sent) for src_sent in src_batch])
+
+        # calculate the features between the src and system_out, parsing the whole batch at once
+        # the absolute values of the gold sources are memoized per language and ranks, load_ranks returns the same
+        # ranks in every call, so evaluating further system outputs in this process reuses them
+        feature_bundles = feature_bins_bundle_corpus(src_batch, tgt_batch, lang, requested_features, feature_bins,
+                                                     frequency_ranks, batch_size=batch_size)
+
+        for f_vals_bin_orig, (f_vals_bin_gen, f_vals_exact) in zip(f_vals_bin_orig_batch, feature_bundles):
+            # change the feature names to abbreviated versions and round the GEN bins to 2 decimals
+            f_vals_bin_gen = {feature2spec_token[f]: round(v, 2) for f, v in f_vals_bin_gen.items()}
+
+            # compare the intended and actual features
+            if f_vals_bin_orig:
+                sent_feat_match = analyze_f_match(f_vals_bin_orig, f_vals_bin_gen)
+                for _f in sent_feat_match["match"]:
+                    feature_matching[_f]["match"] += 1
+                for _misf, _v in sent_feat_match["mismatch"].items():
+                    feature_matching[_misf]["mismatch"].append(_v)
 
     # print some initial results
     total_matches = sum(d["match"] for f, d in feature_matching.items())
@@ -11,8 +11,9 @@ import argparse
 import os
 import subprocess
 from utils.helpers import match_dir_with_features, load_yaml
-from utils.paths import get_data_preprocessed_dir, get_experiment_dir, check_if_dir_exists_and_is_empty, get_evaluation_dir
-from with_fairseq.fairseq_base import preprocess_with_fairseq, train_with_fairseq, generate_with_fairseq, evaluation_automatic_metrics
+from utils.paths import get_data_preprocessed_dir, get_experiment_dir, check_if_dir_exists_and_is_empty, get_evaluation_dir, get_plain_source_dir, get_fairseq_data_dir, binarized_datasets_exist
+from with_fairseq.fairseq_base import preprocess_with_fairseq, train_with_fairseq, generate_with_fairseq, evaluation_automatic_metrics, prepare_feature_control
+from with_fairseq.feature_control_task import FEATURE_CONTROL_TASK
 from evaluation.feature_match_evaluate import parse_file_pair_return_analysis
 import torch
 
@@ -28,14 +29,29 @@ FEATURES_REQUESTED = sorted(config["features_requested"])
 LANG = config["language"].lower()
 EXP_ID = str(config["experiment_id"]).lower()
 PREPROCESS, TRAIN, GENERATE = config["preprocess"], config["train"], config["generate"]
+# prepend the control tokens while fairseq builds the batches instead of using a corpus per feature combination
+ON_THE_FLY_FEATURES = bool(config.get("on_the_fly_features", False))
+TASK = FEATURE_CONTROL_TASK if ON_THE_FLY_FEATURES else "translation"
+# number of data-parallel training processes on the CPU
+DISTRIBUTED_WORLD_SIZE = int(config.get("distributed_world_size", 1))
 # LANG = "en"
 # FEATURES_REQUESTED = ["dependency", "frequency", "length"]
 # HYPERPARAMETERS
 
-hyper = {"lr": float(config["lr"]), "batch_size": int(config["batch_size"]),
-         "test_batch_size": int(config["test_batch_size"]), "beam_size": int(config["beam_size"]),
-         "update_freq": int(config["update_freq"]), "max_epochs": int(config["max_epochs"]),
-         "patience": int(config["patience"])}
+hyper = {"lr": float(config["lr"]), "test_batch_size": int(config["test_batch_size"]),
+         "beam_size": int(config["beam_size"]), "update_freq": int(config["update_freq"]),
+         "max_epochs": int(config["max_epochs"]), "patience": int(config["patience"]),
+         "arch": config.get("arch", "transformer"), "optimizer": config.get("optimizer", "adam")}
+# batching: a fixed number of sentences and/or a budget of tokens per batch, sentences of similar length are put into
+# the same batch with num_batch_buckets > 0
+batching = {"batch_size": int(config["batch_size"]) if config.get("batch_size") else None,
+            "max_tokens": int(config["max_tokens"]) if config.get("max_tokens") else None,
+            "num_batch_buckets": int(config.get("num_batch_buckets", 0)),
+            "num_workers": int(config.get("num_workers", 1)),
+            "data_buffer_size": int(config.get("data_buffer_size", 10))}
+assert batching["batch_size"] or batching["max_tokens"], "batch_size or max_tokens is required"
+# fairseq fills the batches of the length buckets up to max_tokens
+assert batching["max_tokens"] or not batching["num_batch_buckets"], "num_batch_buckets requires max_tokens"
 
 
 lang_allowed = {"en": "English", "de": "German"}
@@ -47,59 +63,81 @@ assert LANG in lang_allowed
 assert set(FEATURES_REQUESTED).issubset(features_allowed)
 
 # prepare names
-# get the feature dir
-input_to_preprocessing_suffix = match_dir_with_features(list(features_allowed), FEATURES_REQUESTED)
-# get the entire path
-dir_input_to_preprocessing = get_data_preprocessed_dir(LANG) / input_to_preprocessing_suffix
-# /home/skrjanec/rewrite_text/data_preprocessed/en/dependency_frequency_length
-
-
-destination_dir_fairseq_preprocessing = dir_input_to_preprocessing / "fairseq"
-
-# if preprocess
-if PREPROCESS:
-    print("... STEP: PREPROCESSING")
-    # the destination directory should be empty otherwise the code will raise an error and finish
-    # here check if the destination exists (else create), and if it's empty
-    check_if_dir_exists_and_is_empty(destination_dir_fairseq_preprocessing)
-
-    preprocess_with_fairseq(data_directory=dir_input_to_preprocessing,
-                            destination_directory=destination_dir_fairseq_preprocessing)
-
-
-# if train
-if TRAIN:
-    print("... STEP: TRAINING")
-    experiment_dir_full = get_experiment_dir(EXP_ID)
-    checkpoint_suffix = "checkpoints"
-    if not os.path.exists(experiment_dir_full):
-        os.makedirs(experiment_dir_full)  # /home/skrjanec/rewrite_text/experiments/03
-
-    train_with_fairseq(dir_with_preprocessed_files=destination_dir_fairseq_preprocessing,
-                       experiment_dir=experiment_dir_full, dir_checkpoints_suffix=checkpoint_suffix,
-                       lr=hyper["lr"], batch_size=hyper["batch_size"], max_epoch=hyper["max_epochs"],
-                       updates=hyper["update_freq"], patience=hyper["patience"])
-
-
-# if generate
-if GENERATE:
-    print("... STEP: INFERENCE")
-    checkpoint_suffix = "checkpoints"
-    experiment_checkpoint_dir_full = get_experiment_dir(EXP_ID) / checkpoint_suffix
-    generate_with_fairseq(dir_with_test_data_and_vocab=destination_dir_fairseq_preprocessing,
-                          dir_with_model_test_data_and_vocab=experiment_checkpoint_dir_full,
-                          batch_size=args["test_batch_size"], beam_size=args["beam_size"])
-
-    torch.cuda.empty_cache()  # will this help with the OOM?
-    # evaluate with EASSE for BLEU, SARI, FKGL and BERTScore, tokenize with Moses.
-    # Write the results into a file in the same directory as  checkpoint_best.pt and generation2.out
-    print("... AUTOMATIC EVALUATION")
-    test_src_path, test_system_path = \
-        evaluation_automatic_metrics(dir_with_model_test_data_and_vocab=experiment_checkpoint_dir_full)
-
-    # evaluate also for the match in feature values between requested and actually generated features
-    # use the paths test_src_path and test_system_path
-
-    # use another function to handle: calling feature extraction, bin preparation
-    # match evaluation
-    parse_file_pair_return_analysis(test_src_path, test_system_path, FEATURES_REQUESTED, LANG)
+if ON_THE_FLY_FEATURES:
+    # one corpus without control tokens and its feature tables for all feature combinations (preprocess.py --plain-source)
+    dir_input_to_preprocessing = get_plain_source_dir(LANG)
+else:
+    # get the feature dir
+    input_to_preprocessing_suffix = match_dir_with_features(list(features_allowed), FEATURES_REQUESTED)
+    # get the entire path
+    dir_input_to_preprocessing = get_data_preprocessed_dir(LANG) / input_to_preprocessing_suffix
+    # /home/skrjanec/rewrite_text/data_preprocessed/en/dependency_frequency_length
+
+
+destination_dir_fairseq_preprocessing = get_fairseq_data_dir(dir_input_to_preprocessing)
+# the datasets are memory-mapped by training and generation instead of read into memory as text
+DATASET_IMPL = "mmap"
+
+if __name__ == "__main__":
+    # the guard keeps the training processes (distributed_world_size > 1) from re-running the steps when they import
+    # this module
+    # if preprocess
+    if PREPROCESS:
+        print("... STEP: PREPROCESSING")
+        if binarized_datasets_exist(destination_dir_fairseq_preprocessing):
+            # preprocess.py --binarize already wrote the dictionaries and the mmap datasets
+            print("... The fairseq datasets in %s are already binarized" % str(destination_dir_fairseq_preprocessing))
+            if ON_THE_FLY_FEATURES:
+                prepare_feature_control(dir_input_to_preprocessing, destination_dir_fairseq_preprocessing)
+        else:
+            # the destination directory should be empty otherwise the code will raise an error and finish
+            # here check if the destination exists (else create), and if it's empty
+            check_if_dir_exists_and_is_empty(destination_dir_fairseq_preprocessing)
+
+            preprocess_with_fairseq(data_directory=dir_input_to_preprocessing,
+                                    destination_directory=destination_dir_fairseq_preprocessing,
+                                    dataset_implementation=DATASET_IMPL, feature_control=ON_THE_FLY_FEATURES)
+
+
+    # if train
+    if TRAIN:
+        print("... STEP: TRAINING")
+        experiment_dir_full = get_experiment_dir(EXP_ID)
+        checkpoint_suffix = "checkpoints"
+        if not os.path.exists(experiment_dir_full):
+            os.makedirs(experiment_dir_full)  # /home/skrjanec/rewrite_text/experiments/03
+
+        train_with_fairseq(dir_with_preprocessed_files=destination_dir_fairseq_preprocessing,
+                           experiment_dir=experiment_dir_full, dir_checkpoints_suffix=checkpoint_suffix,
+                           lr=hyper["lr"], max_epoch=hyper["max_epochs"], updates=hyper["update_freq"],
+                           patience=hyper["patience"], arch=hyper["arch"], optimizer=hyper["optimizer"],
+                           **batching,
+                           dataset_implementation=DATASET_IMPL, task=TASK, features_requested=FEATURES_REQUESTED,
+                           distributed_world_size=DISTRIBUTED_WORLD_SIZE)
+
+
+    # if generate
+    if GENERATE:
+        print("... STEP: INFERENCE")
+        checkpoint_suffix = "checkpoints"
+        experiment_checkpoint_dir_full = get_experiment_dir(EXP_ID) / checkpoint_suffix
+        generate_with_fairseq(dir_with_test_data_and_vocab=destination_dir_fairseq_preprocessing,
+                              dir_with_model_test_data_and_vocab=experiment_checkpoint_dir_full,
+                              batch_size=hyper["test_batch_size"], beam_size=hyper["beam_size"],
+                              dataset_implementation=DATASET_IMPL, task=TASK, features_requested=FEATURES_REQUESTED)
+
+        torch.cuda.empty_cache()  # will this help with the OOM?
+        # evaluate with EASSE for BLEU, SARI, FKGL and BERTScore, tokenize with Moses.
+        # Write the results into a file in the same directory as  checkpoint_best.pt and generation2.out
+        print("... AUTOMATIC EVALUATION")
+        test_src_path, test_system_path = \
+            evaluation_automatic_metrics(dir_with_model_test_data_and_vocab=experiment_checkpoint_dir_full)
+
+        # evaluate also for the match in feature values between requested and actually generated features
+        # use the paths test_src_path and test_system_path
+
+        # use another function to handle: calling feature extraction, bin preparation
+        # match evaluation
+        parse_file_pair_return_analysis(test_src_path, test_system_path, FEATURES_REQUESTED, LANG,
+                                        sidecar_path=dir_input_to_preprocessing / "test.features.npz",
+                                        plain_source=ON_THE_FLY_FEATURES)
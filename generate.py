@@ -14,14 +14,12 @@ lev: feature value float
 
 import argparse
 from pathlib import Path
+from itertools import islice
 import os
 import sys
-from fairseq import options
-from fairseq_cli import generate
-from generation.helpers_generation import update_requested_features_with_bins, copy_vocab_files, preprocess_src_file, \
-    prepare_special_token_string
+from generation.rewriter import Rewriter
 from utils.paths import get_experiment_dir, get_repo_dir
-from utils.helpers import parse_model_hypotheses, log_stdout
+from utils.helpers import yield_lines
 
 parser = argparse.ArgumentParser()
 # parser.add_argument("--model-dir", required=True, help="dir with the checkpoint_best.pt model")
@@ -37,8 +35,6 @@ parser.add_argument("--spacy", action='store_true', required=False, help="set to
 
 args = vars(parser.parse_args())
 
-feature2spec_token = {"dependency": "MaxDep", "frequency": "FreqRank", "length": "Length", "levenshtein": "Leven"}
-
 features_values = {}
 if args["dependency"]:
     features_values["dependency"] = float(args["dependency"])
@@ -52,12 +48,6 @@ if args["length"]:
 if args["levenshtein"]:
     features_values["levenshtein"] = float(args["levenshtein"])
 
-# update the feature_values dict with bin values, round them to 2 decimals too
-features_values = update_requested_features_with_bins(features_values)
-
-text = " \n".join([f_name + ": " + str(f_val) for f_name, f_val in features_values.items()])
-print("Generating with features: \n" + text)
-
 # preparing paths:
 model_dir = get_experiment_dir(args["experiment_id"]) / "checkpoints"
 model_path = model_dir / "checkpoint_best.pt"
@@ -66,55 +56,35 @@ if not os.path.exists(model_dir):
 
 data_dir = Path(get_repo_dir()) / args["data_dir"]
 src_file_path = data_dir / "test.txt"
-
-suffix = "test.src-tgt.src"
-
-src_file_destin = data_dir / suffix
 if not os.path.exists(data_dir):
     sys.exit("Error: This data directory does not exist" + str(data_dir))
 
-source_lang = "src"
-target_lang = "tgt"
-
-# copy the vocabulary dict.* files from the model_dir into the same dir as the test src file
-copy_vocab_files(origin_dir=model_dir, destination_dir=data_dir)
-
-# PREPROCESSING #
-# read in the src-file
-# tokenize each line and prepend the feature values
-# save the file into experiment_id_test.src-tgt.src
 if args["spacy"]:
     tokenizer = 'spacy'
 else:
     tokenizer = 'sentpiece'
-special_token_str = prepare_special_token_string(features_values, feature2spec_token)
-preprocess_src_file(src_file_path, src_file_destin, special_token_str, args['language'], tokenizer)
+
+# the model, the vocabulary dict.* files in model_dir and the tokenizer are loaded once
+rewriter = Rewriter(model_path, model_dir, args["language"], beam=args["beam"], tokenizer_type=tokenizer)
+
+# the feature values are mapped to their bins, rounded to 2 decimals
+text = " \n".join([f_name + ": " + str(f_val) for f_name, f_val in rewriter.bin_features(features_values).items()])
+print("Generating with features: \n" + text)
 
 
 # GENERATING: INFERENCE #
 print("+++ INFERENCE +++")
-def generate_main():
-    # fairseq.generate --> write the output into a temp file
-    inference_args = [data_dir, "--path", model_path, "--batch-size", 12, "--beam", args["beam"],
-                      "--dataset-impl", "raw", "--source-lang", source_lang, "--target-lang", target_lang]
-    print("ARGUMENTS FOR DECODING", inference_args)
-    inference_args = [str(a) for a in inference_args]
-    inference_parser = options.get_generation_parser()
-    inf_args = options.parse_args_and_arch(inference_parser, inference_args)
-
-    out_temp = str(data_dir / "generation.out")
-    with log_stdout(out_temp, mute_stdout=True):
-        generate.main(inf_args)
-    # parse this file to fetch out the hypotheses H-N, order them 0, 1, 2...
-    ordered_hypotheses = parse_model_hypotheses(out_temp)
+def generate_main(batch_size=1024):
+    # the sentences are tokenized, the control tokens prepended and the best hypotheses written in the original order
     suffix_out = args["experiment_id"] + "_generation.out"
     out_file2 = str(data_dir / suffix_out)
+    lines = yield_lines(src_file_path)
     with open(out_file2, "w") as fout:
-        for line in ordered_hypotheses:
-            fout.write(line[0] + "\n")
+        batch = list(islice(lines, batch_size))
+        while batch:
+            for hypotheses in rewriter.rewrite(batch, features_values):
+                fout.write(hypotheses[0]["tokens"] + "\n")
+            batch = list(islice(lines, batch_size))
 
 
 generate_main()
-
-
-
@@ -0,0 +1,130 @@
+"""
+Rewriting in the current process with a model that is loaded once
+
+A Rewriter holds the model ensemble of a checkpoint, its dictionaries, the generator (fairseq's SequenceGenerator),
+the tokenizer and the feature bins. Lists of sentences with control values are decoded directly, without writing the
+sentences into files, copying vocabularies or parsing the output of fairseq-generate.
+
+rewriter = Rewriter.from_experiment("03", "en", beam=8)
+rewriter.rewrite(["A long sentence."], {"length": 0.75})
+-> [[{"text": "A sentence.", "tokens": "▁A ▁sentence .", "score": -0.41}, ...]]
+"""
+
+import torch
+from fairseq import checkpoint_utils, utils
+from utils.feature_bin_preparation import get_feature_bins
+from utils.helpers import get_control_token, load_tokenizer, tokenize_batch
+from utils.paths import get_experiment_dir
+import with_fairseq  # registers the task feature_control_translation of the models trained with on_the_fly_features
+
+FEATURES = ["dependency", "frequency", "length", "levenshtein"]
+SENTENCEPIECE_SPACE = "▁"
+
+
+class Rewriter:
+    """
+    model_path: the checkpoint, dict_dir: the directory with dict.src.txt and dict.tgt.txt of the model
+    lang, tokenizer_type: the tokenizer of the sentences, "sentpiece" or "spacy"
+    beam, nbest: beam size and number of hypotheses returned per sentence
+    batch_size: maximum number of sentences decoded together, the sentences are batched by length
+    """
+    def __init__(self, model_path, dict_dir, lang=None, beam=8, nbest=1, tokenizer_type="sentpiece", batch_size=64,
+                 use_cuda=None):
+        self.tokenizer_type = tokenizer_type
+        # without lang only tokenized sentences can be rewritten (rewrite_tokenized)
+        self.tokenizer_model = load_tokenizer(tokenizer_type, lang) if lang else None
+        self.feature_bins = get_feature_bins()
+        self.batch_size = batch_size
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self.models, self.cfg, self.task = checkpoint_utils.load_model_ensemble_and_task(
+            [str(model_path)], arg_overrides={"data": str(dict_dir)})
+        for model in self.models:
+            model.eval()
+            if self.use_cuda:
+                model.cuda()
+        self.src_dict, self.tgt_dict = self.task.source_dictionary, self.task.target_dictionary
+        self.cfg.generation.beam = beam
+        self.cfg.generation.nbest = nbest
+        self.generator = self.task.build_generator(self.models, self.cfg.generation)
+        # the symbols fairseq-generate removes from the hypotheses, eos (and bos for some generators)
+        self.symbols_to_strip = getattr(self.generator, "symbols_to_strip_from_output", {self.tgt_dict.eos()})
+
+    @classmethod
+    def from_experiment(cls, experiment_id, lang, model_name="checkpoint_best.pt", **kwargs):
+        """ The model of experiments/[experiment_id]/checkpoints, the dictionaries are in the same directory """
+        model_dir = get_experiment_dir(experiment_id) / "checkpoints"
+        return cls(model_dir / model_name, model_dir, lang, **kwargs)
+
+    def bin_features(self, features_values):
+        """ Return the bin values of the requested feature values, rounded to 2 decimals like the control tokens """
+        unknown = set(features_values) - set(FEATURES)
+        if unknown:
+            raise ValueError("Unknown features: %s, options: %s" % (", ".join(sorted(unknown)), ", ".join(FEATURES)))
+        return {f: round(float(self.feature_bins.bin_values(f, [float(v)])[0]), 2) for f, v in features_values.items()}
+
+    def control_prefix(self, features_values):
+        """ The control tokens of the requested feature values, e.g. "<Length_0.75> <Leven_0.8> " """
+        binned = self.bin_features(features_values)
+        return "".join(get_control_token(f, binned[f]) + " " for f in sorted(binned))
+
+    def rewrite(self, sentences, features_values=None):
+        """ Rewrite untokenized sentences. features_values: a dictionary feature: value for all sentences, or a list
+        with a dictionary for every sentence. Return the hypotheses of every sentence, see rewrite_tokenized """
+        if features_values is None or isinstance(features_values, dict):
+            prefixes = [self.control_prefix(features_values or {})] * len(sentences)
+        else:
+            prefixes = [self.control_prefix(values) for values in features_values]
+        return self.rewrite_with_prefixes(sentences, prefixes)
+
+    def rewrite_with_prefixes(self, sentences, prefixes):
+        """ Rewrite untokenized sentences, prefixes: the control tokens of every sentence as a string """
+        if self.tokenizer_model is None:
+            raise ValueError("The Rewriter was created without a language, it only rewrites tokenized sentences")
+        tokenized = tokenize_batch(sentences, self.tokenizer_type, self.tokenizer_model)
+        return self.rewrite_tokenized([prefix + " ".join(tokens) for prefix, tokens in zip(prefixes, tokenized)])
+
+    def rewrite_tokenized(self, lines):
+        """
+        Rewrite tokenized sentences that already start with their control tokens (the format of the preprocessed
+        source files). Return for every line, in the order of the lines, the nbest hypotheses, best first, as
+        dictionaries with the detokenized "text", the "tokens" (the string fairseq-generate prints) and the "score"
+        (the length-normalized log probability)
+        """
+        tokens = [self.src_dict.encode_line(line, add_if_not_exist=False).long() for line in lines]
+        # batches of sentences of similar length, less padding
+        order = sorted(range(len(tokens)), key=lambda i: tokens[i].numel())
+        hypotheses = [None] * len(lines)
+        for start in range(0, len(order), self.batch_size):
+            batch_ids = order[start:start + self.batch_size]
+            batch_hypotheses = self.decode_batch([tokens[i] for i in batch_ids])
+            for i, line_hypotheses in zip(batch_ids, batch_hypotheses):
+                hypotheses[i] = line_hypotheses
+        return hypotheses
+
+    def decode_batch(self, tokens):
+        """ Run the generator on a batch of token id tensors, return the hypotheses in the order of tokens """
+        dataset = self.task.build_dataset_for_inference(tokens, [t.numel() for t in tokens])
+        sample = dataset.collater([dataset[i] for i in range(len(dataset))])
+        if self.use_cuda:
+            sample = utils.move_to_cuda(sample)
+        with torch.no_grad():
+            generated = self.task.inference_step(self.generator, self.models, sample)
+
+        # the collater sorts the batch by length, sample["id"] is the position in tokens
+        hypotheses = [None] * len(tokens)
+        for sample_id, sentence_hypotheses in zip(sample["id"].tolist(), generated):
+            hypotheses[sample_id] = [self.hypothesis(h) for h in sentence_hypotheses[:self.cfg.generation.nbest]]
+        return hypotheses
+
+    def hypothesis(self, generated):
+        _, hypothesis_tokens, _ = utils.post_process_prediction(
+            hypo_tokens=generated["tokens"].int().cpu(), src_str="", alignment=None, align_dict=None,
+            tgt_dict=self.tgt_dict, remove_bpe=None,
+            extra_symbols_to_ignore=self.symbols_to_strip)
+        return {"text": self.detokenize(hypothesis_tokens), "tokens": hypothesis_tokens,
+                "score": float(generated["score"])}
+
+    def detokenize(self, hypothesis_tokens):
+        if self.tokenizer_type == "spacy":
+            return hypothesis_tokens
+        return "".join(hypothesis_tokens.split()).replace(SENTENCEPIECE_SPACE, " ").strip()
@@ -0,0 +1,209 @@
+"""
+Local inference server: the Rewriter (generation/rewriter.py) of an experiment is loaded once and serves rewrite
+requests over HTTP
+
+Concurrent requests are put into a queue. A single decoding thread takes the first waiting request and waits at most
+max_latency seconds for more requests, until max_batch_size sentences are collected, then the sentences of all these
+requests are decoded as one batch. Every sentence carries its own control tokens, so requests with different feature
+values share a batch.
+
+POST /rewrite  {"sentences": [...], "features": {"length": 0.75, ...}}  ->  {"rewrites": [...]}
+               "features" is either one dictionary for all sentences or a list with a dictionary per sentence
+GET  /stats    request, sentence and batch counters, the current queue depth and the latencies of recent requests
+GET  /health   {"status": "ok"}
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
+
+
+class PendingRequest:
+    def __init__(self, sentences, prefixes):
+        self.sentences = sentences
+        self.prefixes = prefixes
+        self.arrived = time.monotonic()
+        self.done = threading.Event()
+        self.rewrites = None
+        self.error = None
+
+
+class MicroBatcher:
+    """ Collects the sentences of concurrent requests into batches for rewrite_batch(sentences, prefixes), a batch is
+    decoded when it has max_batch_size sentences or when its first request has waited max_latency seconds """
+    def __init__(self, rewrite_batch, max_batch_size=32, max_latency=0.02, n_recent=1000):
+        self.rewrite_batch = rewrite_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "sentences": 0, "batches": 0, "errors": 0, "decoding_seconds": 0.0}
+        self.in_flight = 0
+        # latencies of the last n_recent requests in milliseconds
+        self.latencies = deque(maxlen=n_recent)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences, prefixes):
+        """ Block until the sentences are rewritten, return the rewrites """
+        request = PendingRequest(sentences, prefixes)
+        self.queue.put(request)
+        request.done.wait()
+        with self.lock:
+            self.counters["requests"] += 1
+            self.latencies.append(1000 * (time.monotonic() - request.arrived))
+        if request.error is not None:
+            raise request.error
+        return request.rewrites
+
+    def collect(self):
+        """ Wait for a request, then for more requests until the batch is full or the deadline of the first passed """
+        batch = [self.queue.get()]
+        n_sentences = len(batch[0].sentences)
+        deadline = batch[0].arrived + self.max_latency
+        while n_sentences < self.max_batch_size:
+            # requests that queued up while the previous batch was decoded are taken without waiting
+            timeout = deadline - time.monotonic()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            with self.lock:
+                self.in_flight = len(batch)
+            sentences = [sentence for request in batch for sentence in request.sentences]
+            prefixes = [prefix for request in batch for prefix in request.prefixes]
+            start = time.monotonic()
+            try:
+                rewrites = []
+                # a single large request is decoded in batches of max_batch_size as well
+                for i in range(0, len(sentences), self.max_batch_size):
+                    rewrites += self.rewrite_batch(sentences[i:i + self.max_batch_size],
+                                                   prefixes[i:i + self.max_batch_size])
+                    with self.lock:
+                        self.counters["batches"] += 1
+                position = 0
+                for request in batch:
+                    request.rewrites = rewrites[position:position + len(request.sentences)]
+                    position += len(request.sentences)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                with self.lock:
+                    self.counters["errors"] += len(batch)
+            with self.lock:
+                self.counters["sentences"] += len(sentences)
+                self.counters["decoding_seconds"] += time.monotonic() - start
+                self.in_flight = 0
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["queue_depth"] = self.queue.qsize()
+            stats["in_flight"] = self.in_flight
+            stats["mean_batch_size"] = stats["sentences"] / stats["batches"] if stats["batches"] else None
+            latencies = np.array(self.latencies)
+        for name, q in [("p50", 50), ("p95", 95), ("p99", 99)]:
+            stats["latency_ms_" + name] = float(np.percentile(latencies, q)) if len(latencies) else None
+        stats["latency_ms_mean"] = float(latencies.mean()) if len(latencies) else None
+        return stats
+
+
+def rewrite_best(rewriter):
+    """ The batch function of the MicroBatcher: the detokenized best hypothesis of every sentence """
+    def rewrite_batch(sentences, prefixes):
+        return [hypotheses[0]["text"] for hypotheses in rewriter.rewrite_with_prefixes(sentences, prefixes)]
+    return rewrite_batch
+
+
+def parse_rewrite_request(content, control_prefix):
+    """ Return (sentences, control prefixes) of the JSON body of a /rewrite request,
+    control_prefix: returns the control tokens of a dictionary of feature values """
+    if not isinstance(content, dict):
+        raise ValueError("the request has to be a JSON object with \"sentences\" and \"features\"")
+    sentences = content.get("sentences")
+    if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+        raise ValueError("\"sentences\" has to be a list of strings")
+    features = content.get("features", {})
+    if isinstance(features, dict):
+        check_feature_values(features)
+        prefixes = [control_prefix(features)] * len(sentences)
+    elif isinstance(features, list) and len(features) == len(sentences):
+        for f in features:
+            check_feature_values(f)
+        prefixes = [control_prefix(f) for f in features]
+    else:
+        raise ValueError("\"features\" has to be a dictionary or a list with a dictionary for every sentence")
+    return sentences, prefixes
+
+
+def check_feature_values(features):
+    """ Raise a ValueError unless features is a dictionary with a number for every feature """
+    if not isinstance(features, dict):
+        raise ValueError("the features of a sentence have to be a dictionary feature: value")
+    for feature, value in features.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("the value of feature \"%s\" has to be a number, not %s" % (feature, json.dumps(value)))
+
+
+class RewriteRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path != "/rewrite":
+            self.send_json(404, {"error": "unknown path " + self.path})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            sentences, prefixes = parse_rewrite_request(json.loads(self.rfile.read(length).decode("utf-8")),
+                                                        self.server.control_prefix)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        try:
+            rewrites = self.server.batcher.submit(sentences, prefixes) if sentences else []
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"rewrites": rewrites})
+
+    def log_message(self, format, *args):
+        # one line per request would dominate the output, the counters are in /stats
+        pass
+
+
+class RewriteServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server with a thread per connection, all threads hand their sentences to the same MicroBatcher """
+    daemon_threads = True
+
+    def __init__(self, address, batcher, control_prefix):
+        super().__init__(address, RewriteRequestHandler)
+        self.batcher = batcher
+        self.control_prefix = control_prefix
@@ -16,16 +16,40 @@ Extract features and write these files in data_preprocessed/
 
 import yaml
 import argparse
-from utils.helpers import load_yaml, load_tokenizer, yield_lines_in_parallel, prepend_feature_to_string, plot_histogram
-from utils.paths import get_input_filepaths_dict, get_out_filepaths_dict, get_phase_suffix_pairs, get_out_shardpath_dict, get_input_shardpath_dict
-from utils.feature_extraction import feature_bins_bundle_sentence, feature_bundle_sentence
-from utils.prepare_word_embeddings_frequency_ranks import load_ranks
-from utils.feature_bin_preparation import create_bins
+import os
+import sys
+from utils.helpers import load_yaml, yield_batches_in_parallel, plot_histogram
+from utils.paths import get_data_preprocessed_dir, get_input_filepaths_dict, get_out_filepaths_dict, get_phase_suffix_pairs, get_out_shardpath_dict, get_input_shardpath_dict, plain_source_dir_name, get_fairseq_data_dir, remove_binarized_split
+from utils.preprocessing import preprocess_chunks
+from utils.shard_manifest import get_shard, describe_shard, yield_shard_batches
+from utils.feature_sidecar import FeatureSidecarWriter, get_sidecar_path, load_sidecar
+from utils.preprocessing_journal import PreprocessingJournal, get_journal_path, get_partial_path, fsync_file
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config", required=True, help="yaml config file for preprocessing src and tgt")
 parser.add_argument("--tokenizer", required=False, help="the tokenizer to use for tokenizing the corpus, either 'spacy' or 'sentpiece'")
-parser.add_argument("--shard", required=False, help="if used this should be the name of the shard file")
+parser.add_argument("--shard", required=False, help="if used this should be the name of the shard, see "
+                                                    "additional_scripts/shard_processing_create.py")
+parser.add_argument("--batch-size", required=False, type=int, default=256,
+                    help="number of sentence pairs parsed together with spacy's nlp.pipe, default 256")
+parser.add_argument("--workers", required=False, type=int, default=1,
+                    help="number of worker processes for feature extraction and tokenization, default 1")
+parser.add_argument("--chunk-size", required=False, type=int, default=1024,
+                    help="number of sentence pairs handed to a worker at once, default 1024")
+parser.add_argument("--feature-cache", required=False,
+                    help="path to the SQLite cache of exact feature values, default: "
+                         "data_preprocessed/[lang]/feature_cache.sqlite")
+parser.add_argument("--no-feature-cache", action="store_true", required=False,
+                    help="compute all features from scratch without reading or writing the feature cache")
+parser.add_argument("--plain-source", action="store_true", required=False,
+                    help="write the sources without control tokens into data_preprocessed/[lang]/plain, the feature "
+                         "values only go into the feature sidecars (for the fairseq task feature_control_translation)")
+parser.add_argument("--resume", action="store_true", required=False,
+                    help="continue an interrupted run after the last chunk in its journal, splits that are done are "
+                         "skipped; without --resume every split is preprocessed from the first line")
+parser.add_argument("--binarize", action="store_true", required=False,
+                    help="also build the fairseq dictionaries from the train split and write the fairseq mmap datasets "
+                         "into the fairseq directory next to the output, while the corpus is preprocessed")
 args = vars(parser.parse_args())
 
 config = load_yaml(args["config"])
@@ -37,7 +61,17 @@ features_allowed = {"dependency", "frequency", "length", "levenshtein"}
 splits_allowed = {"train", "valid", "test"}
 
 TOKENIZER_TYPE = args["tokenizer"] if args["tokenizer"] else 'sentpiece'
-TOKENIZER_MODEL = load_tokenizer(TOKENIZER_TYPE, LANG)
+BATCH_SIZE = args["batch_size"]
+WORKERS = args["workers"]
+CHUNK_SIZE = args["chunk_size"]
+PLAIN_SOURCE = args["plain_source"]
+RESUME = args["resume"]
+BINARIZE = args["binarize"]
+if args["no_feature_cache"]:
+    FEATURE_CACHE_PATH = None
+else:
+    FEATURE_CACHE_PATH = args["feature_cache"] if args["feature_cache"] else \
+        get_data_preprocessed_dir(LANG) / "feature_cache.sqlite"
 
 # some checks
 assert LANG in lang_allowed
@@ -45,63 +79,154 @@ assert set(FEATURES_REQUESTED).issubset(features_allowed)
 print("... Preprocessing %s corpora and extracting features: %s " % (lang_allowed[config["lang"]],
                                                                      ", ".join(FEATURES_REQUESTED)))
 
+# the output directory is named after the features, or "plain" if the features are not prepended
+output_dir_features = [plain_source_dir_name] if PLAIN_SOURCE else FEATURES_REQUESTED
+
 shard_file = args["shard"]
+# a shard of the manifest is a byte range of the original files, read directly; else a shard file in data_shards
+shard = get_shard(LANG, shard_file) if shard_file else None
 if shard_file:
     input_file_paths = get_input_shardpath_dict(shard_file, LANG)
-    output_file_paths = get_out_shardpath_dict(shard_file, LANG, FEATURES_REQUESTED)
+    output_file_paths = get_out_shardpath_dict(shard_file, LANG, output_dir_features)
     parallel_pairs_list = [[(shard_file, "src"), (shard_file, "tgt")]]
 else:
     input_file_paths = get_input_filepaths_dict(LANG)
-    output_file_paths = get_out_filepaths_dict(LANG, FEATURES_REQUESTED)
+    output_file_paths = get_out_filepaths_dict(LANG, output_dir_features)
     parallel_pairs_list = get_phase_suffix_pairs()
 
-feature_bins = create_bins()
+# the dictionaries are built from the whole train split, a shard is binarized after the merge by fairseq-preprocess
+if BINARIZE and shard_file:
+    sys.exit("Error: --binarize cannot be used with --shard")
+FAIRSEQ_DIR = get_fairseq_data_dir(output_file_paths[parallel_pairs_list[0][0]].parent)
+if BINARIZE:
+    from with_fairseq.streaming_binarization import SplitBinarizer, new_dictionaries, load_dictionaries, \
+        save_dictionaries
 
-frequency_ranks = load_ranks(LANG)
 
+def finish_phase(out_paths, partial_paths):
+    """ Move the completed temp files to the final files, can be repeated if the process dies while doing it """
+    for name in ["src", "tgt", "sidecar"]:
+        if os.path.exists(partial_paths[name]):
+            os.replace(partial_paths[name], out_paths[name])
+    if os.path.exists(partial_paths["spool"]):
+        os.remove(partial_paths["spool"])
 
-def phase_open_process_write(src_tuple, tgt_tuple, in_src_PATH, in_tgt_PATH):
-    """ ("phase", "src"), ("phase", "tgt") """
-    # open the out files
-    new_source = open(output_file_paths[src_tuple], "w", encoding="utf-8")
-    new_target = open(output_file_paths[tgt_tuple], "w", encoding="utf-8")
 
-    feature_dict_vals = {feat: [] for feat in FEATURES_REQUESTED}
+def open_truncated(path, size):
+    """ Open a temp file for appending after its first size bytes, the bytes of uncommitted chunks are dropped """
+    if size > 0 and (not os.path.exists(path) or os.path.getsize(path) < size):
+        sys.exit("Error: %s is shorter than its journal says, run without --resume" % str(path))
+    f = open(path, "ab")
+    f.truncate(size)
+    return f
 
-    for src_sent, tgt_sent in yield_lines_in_parallel([in_src_PATH, in_tgt_PATH], strict=True):
-        f_vals_bin, f_vals_exact = feature_bins_bundle_sentence(src_sent, tgt_sent, LANG, FEATURES_REQUESTED,
-                                                                feature_bins, frequency_ranks)
-        sent_src_new, sent_tgt_new = prepend_feature_to_string(src_sent, tgt_sent, FEATURES_REQUESTED,
-                                                               f_vals_bin, TOKENIZER_TYPE, TOKENIZER_MODEL)
-        new_source.write(sent_src_new + "\n")
-        new_target.write(sent_tgt_new + "\n")
 
-        if config["analyze_features"]:
-            for f, v in f_vals_exact.items():
-                feature_dict_vals[f].append(v)
+def phase_open_process_write(src_tuple, tgt_tuple, in_src_PATH, in_tgt_PATH):
+    """ ("phase", "src"), ("phase", "tgt") """
+    out_paths = {"src": output_file_paths[src_tuple], "tgt": output_file_paths[tgt_tuple],
+                 "sidecar": get_sidecar_path(output_file_paths[src_tuple])}
+    partial_paths = {name: get_partial_path(path) for name, path in out_paths.items()}
+    partial_paths["spool"] = get_partial_path(out_paths["sidecar"].with_suffix(".spool"))
+
+    # the progress of the split: number of input lines done and the sizes of the temp files after them
+    journal = PreprocessingJournal(get_journal_path(out_paths["src"]))
+    input_description = describe_shard(shard) if shard else [str(in_src_PATH), str(in_tgt_PATH)]
+    settings = {"input": input_description, "features": FEATURES_REQUESTED,
+                "tokenizer": TOKENIZER_TYPE, "plain_source": PLAIN_SOURCE, "binarize": BINARIZE}
+    n_lines_done, sizes = 0, {"src": 0, "tgt": 0, "spool": 0}
+    journal_settings, last_record, complete = journal.read() if RESUME else (None, None, False)
+    if journal_settings is not None and journal_settings != settings:
+        sys.exit("Error: %s was written with other settings, run without --resume" % str(journal.path))
+    if complete:
+        finish_phase(out_paths, partial_paths)
+        print("... %s is already preprocessed, skipping" % str(out_paths["src"]))
+        exact = load_sidecar(out_paths["sidecar"])["exact"] if config["analyze_features"] else None
+        return {feat: exact[:, j].tolist() if exact is not None else [] for j, feat in enumerate(FEATURES_REQUESTED)}
+    if last_record is not None:
+        n_lines_done, sizes = last_record["lines"], last_record["sizes"]
+        print("... Resuming %s after line %d" % (str(out_paths["src"]), n_lines_done))
+    if journal_settings is None:
+        journal.start(settings)
+    split = src_tuple[0]
+    if not shard_file:
+        # binarized datasets of an earlier run do not match the text written now
+        remove_binarized_split(FAIRSEQ_DIR, split)
+
+    # open the out files, the lines are written as bytes so that the file positions are byte offsets
+    new_source = open_truncated(partial_paths["src"], sizes["src"])
+    new_target = open_truncated(partial_paths["tgt"], sizes["tgt"])
+    open_truncated(partial_paths["spool"], sizes["spool"]).close()
+
+    # exact values and bin indices as columns, written next to the src file
+    sidecar = FeatureSidecarWriter(FEATURES_REQUESTED, spool_path=partial_paths["spool"])
+
+    binarizer = None
+    if BINARIZE:
+        # the train split builds the dictionaries, valid and test are encoded with the saved ones
+        dictionaries = new_dictionaries() if split == "train" else load_dictionaries(FAIRSEQ_DIR)
+        binarizer = SplitBinarizer(FAIRSEQ_DIR, split, dictionaries, add_symbols=(split == "train"))
+        # the token ids of the committed lines are not journaled, they are computed again from the text
+        binarizer.replay("src", partial_paths["src"])
+        binarizer.replay("tgt", partial_paths["tgt"])
+
+    # the chunks are processed in order, or in parallel by WORKERS processes and collected in the original order
+    if shard:
+        chunks = yield_shard_batches(shard, CHUNK_SIZE, skip=n_lines_done)
+    else:
+        chunks = yield_batches_in_parallel([in_src_PATH, in_tgt_PATH], CHUNK_SIZE, strict=True, skip=n_lines_done)
+    for processed_chunk in preprocess_chunks(chunks, LANG, FEATURES_REQUESTED, TOKENIZER_TYPE, BATCH_SIZE, WORKERS,
+                                             FEATURE_CACHE_PATH, PLAIN_SOURCE):
+        src_lines = []
+        for sent_src_new, sent_tgt_new, f_vals_exact in processed_chunk:
+            src_lines.append(sent_src_new + "\n")
+            sidecar.add(f_vals_exact, src_lines[-1])
+        tgt_lines = [sent_tgt_new + "\n" for _, sent_tgt_new, _ in processed_chunk]
+        # the lines of a chunk are written at once
+        new_source.write("".join(src_lines).encode("utf-8"))
+        new_target.write("".join(tgt_lines).encode("utf-8"))
+        if binarizer is not None:
+            binarizer.add("src", src_lines)
+            binarizer.add("tgt", tgt_lines)
+
+        # commit the chunk: everything up to here is on disk and is not computed again by --resume
+        n_lines_done += len(processed_chunk)
+        fsync_file(new_source)
+        fsync_file(new_target)
+        journal.commit(n_lines_done, {"src": new_source.tell(), "tgt": new_target.tell(), "spool": sidecar.flush()})
 
     # close the out files
     new_target.close()
     new_source.close()
-
-    return feature_dict_vals
-
-
-all_phases_all_feature_values = {feat: [] for feat in FEATURES_REQUESTED}
-
-for phase in parallel_pairs_list:
-    # phase is "train", "val" or "test"
-    # tuple_src is (phase, "src") and tuple_tgt is (phase, "tgt")
-    tuple_src, tuple_tgt = phase[0], phase[1]
-    input_src_path = input_file_paths[tuple_src]
-    input_tgt_path = input_file_paths[tuple_tgt]
-    feature_d_values = phase_open_process_write(tuple_src, tuple_tgt, input_src_path, input_tgt_path)
-    for f, v in feature_d_values.items():
-        """ f is a str, v is a list """
-        all_phases_all_feature_values[f].extend(v)
-
-if config["analyze_features"]:
-    for f, _x in all_phases_all_feature_values.items():
-        plot_histogram(_x, f, LANG)
-
-print("Finished Feature Extraction")
\ No newline at end of file
+    sidecar.write(partial_paths["sidecar"])
+    if binarizer is not None:
+        binarizer.finish()
+        if split == "train":
+            save_dictionaries(FAIRSEQ_DIR, binarizer.dictionaries)
+    journal.complete()
+    finish_phase(out_paths, partial_paths)
+
+    if not config["analyze_features"]:
+        return {feat: [] for feat in FEATURES_REQUESTED}
+    return {feat: values.tolist() for feat, values in sidecar.exact_columns().items()}
+
+
+if __name__ == "__main__":
+    # the guard keeps worker processes (--workers) from re-running the preprocessing when they import this module
+    all_phases_all_feature_values = {feat: [] for feat in FEATURES_REQUESTED}
+
+    for phase in parallel_pairs_list:
+        # phase is "train", "val" or "test"
+        # tuple_src is (phase, "src") and tuple_tgt is (phase, "tgt")
+        tuple_src, tuple_tgt = phase[0], phase[1]
+        input_src_path = input_file_paths[tuple_src]
+        input_tgt_path = input_file_paths[tuple_tgt]
+        feature_d_values = phase_open_process_write(tuple_src, tuple_tgt, input_src_path, input_tgt_path)
+        for f, v in feature_d_values.items():
+            """ f is a str, v is a list """
+            all_phases_all_feature_values[f].extend(v)
+
+    if config["analyze_features"]:
+        for f, _x in all_phases_all_feature_values.items():
+            plot_histogram(_x, f, LANG)
+
+    print("Finished Feature Extraction")
\ No newline at end of file
@@ -12,23 +12,31 @@ of SARI and FKGL. I want to create versions of the source side of WikiLarge with
 - only 2
 - only 1
 
+Every split of the 4-feature corpus is read once and the lines are written into the files of all feature combinations
+at the same time; the splits are processed in parallel. The target side is the same for all combinations, so the
+target files are hard-linked (copied if the file system does not support hard links).
+
+python remove_features_from_file.py --lang en [--input-dir data_preprocessed/en/dependency_frequency_length_levenshtein]
 """
-import git
-from pathlib import Path
+import argparse
 import os
+import shutil
+from array import array
+from contextlib import ExitStack
 from itertools import combinations
+from multiprocessing import Pool
+from pathlib import Path
 from utils.helpers import yield_lines
+from utils.paths import get_data_preprocessed_dir
 from evaluation.feature_match_evaluate import remove_features_from_str
+from utils.feature_sidecar import get_sidecar_path, load_matching_sidecar, sidecar_bin_values, strip_control_tokens, \
+    line_lengths_to_offsets, write_sidecar
 
-LANG = "en"
 splits_allowed = ["train", "valid", "test"]
 features_allowed = ["dependency", "frequency", "length", "levenshtein"]
 feature2spec_token = {"dependency": "MaxDep", "frequency": "FreqRank", "length": "Length", "levenshtein": "Leven"}
 suffix_allowed = ".src"
-
-repo = git.Repo('utils', search_parent_directories=True)
-REPO_DIR = repo.working_tree_dir
-path_to_4features_dir = Path(REPO_DIR) / "data_preprocessed" / LANG / "dependency_frequency_length_levenshtein"
+target_suffix = ".tgt"
 
 
 def create_f_combinations(list_of_features):
@@ -44,59 +52,109 @@ def create_f_combinations(list_of_features):
     return list_combinations
 
 
-def make_path_make_dir(f_combination):
+def make_path_make_dir(f_combination, output_dir):
     # for a given list of requested features, create a full path to this directory and create a dir
-    part1 = Path(REPO_DIR) / "data_preprocessed" / LANG
     # concatenate the feature names
-    part2 = "_".join(f_combination)
-    datadir = part1 / part2
+    datadir = Path(output_dir) / "_".join(f_combination)
     if not os.path.exists(datadir):
         os.mkdir(datadir)
-    print("Created directory ", str(datadir))
+        print("Created directory ", str(datadir))
     return datadir
 
 
-def select_relevant_features_return_str(f_combination, feat_dict):
-    """
-    :param f_combination: a list with desired features, e.g. ['dependency', 'levenshtein']
-    :param feat_dict: a dict with feature tokens and their values for the current sentence, e.g.
-        "MaxDep": 1.0, "FreqRank": 0.8, "Length": 1.05, "Leven": 0.45
-    :return: a str that is to be prepended to the src sentence, e.g. "<MaxDep_1.0> <Leven_0.45> "
-    """
-    f_relevant_d = {feature2spec_token[f_name]: feat_dict[feature2spec_token[f_name]] for f_name in f_combination}
-    s = ""
-    for k, v in f_relevant_d.items():
-        s += "<" + k + "_" + str(v) + "> "
-    return s
-
-
-all_combinations = create_f_combinations(features_allowed)
-for combi in all_combinations:
-    c_datadir = make_path_make_dir(combi)
-    for split in splits_allowed:
-        # open a file
-        c_suffix = split + suffix_allowed
-        new_file_path = c_datadir / c_suffix
-        new_file = open(new_file_path, "w")
-        src_file_path = path_to_4features_dir / c_suffix
+def yield_feature_dicts_and_sentences(src_file_path, sidecar=None):
+    """ Yield (feature token: value dict, sentence without control tokens) for every line of the 4-feature file.
+    The values are read from the columnar sidecar of the file if given (see load_matching_sidecar), else parsed from
+    the text """
+    if sidecar is None:
         for f_sentence in yield_lines(src_file_path):
-            f_dict, sentence = remove_features_from_str(f_sentence)
-            prepend = select_relevant_features_return_str(combi, f_dict)
-            sentence = prepend + sentence
-            new_file.write(sentence + "\n")
-        new_file.close()
-        print("... Wrote file in ", str(new_file_path))
-
-# create feature combinations, put them into a list
-
-# for every feature combination, do
-#   create a directory in data_preprocessed/en/
-#   for every split in splits_allowed:
-#       open the split in path_to_4features_dir / split.src:
-#           yield_lines
-#           pass the line to remove_features_from_str; feat_dict, sentence = remove_features_from_str(line)
-#           from the feat_dict, keep only those from feature_combination
-#               prepend again to the sentence and write into open file
-#           close the open file
-
-
+            yield remove_features_from_str(f_sentence)
+        return
+
+    bin_values = sidecar_bin_values(sidecar)
+    n_features = len(sidecar["features"])
+    for i, f_sentence in enumerate(yield_lines(src_file_path)):
+        f_dict = {feature2spec_token[f]: float(bin_values[f][i]) for f in sidecar["features"]}
+        yield f_dict, strip_control_tokens(f_sentence, n_features)
+
+
+def link_or_copy(src_path, dst_path):
+    """ Hard-link src_path to dst_path, replacing an existing dst_path; copy if hard links are not possible """
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def write_subset_sidecars(sidecar, out_paths, line_lengths, all_combinations):
+    """ Write the sidecar of every feature combination: the columns of its features and its own line offsets """
+    for combi in all_combinations:
+        columns = [sidecar["features"].index(f) for f in combi]
+        write_sidecar(get_sidecar_path(out_paths[tuple(combi)]), combi, sidecar["exact"][:, columns],
+                      sidecar["bins"][:, columns], line_lengths_to_offsets(line_lengths[tuple(combi)]))
+
+
+def fan_out_split(split, input_dir, output_dir, all_combinations):
+    """ Read the source file of split once and write it into the directories of all feature combinations """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    src_file_path = input_dir / (split + suffix_allowed)
+    if not src_file_path.exists():
+        print("... No %s in %s, skipping" % (src_file_path.name, str(input_dir)))
+        return split, 0
+
+    out_paths = {tuple(combi): output_dir / "_".join(combi) / (split + suffix_allowed) for combi in all_combinations}
+    sidecar = load_matching_sidecar(src_file_path)
+    has_sidecar = sidecar is not None
+    line_lengths = {key: array("q") for key in out_paths}
+    n_lines = 0
+    with ExitStack() as stack:
+        out_files = {key: stack.enter_context(open(path, "w", encoding="utf-8")) for key, path in out_paths.items()}
+        for f_dict, sentence in yield_feature_dicts_and_sentences(src_file_path, sidecar):
+            # build every control token once per line, the combinations only concatenate them
+            spec_tokens = {f: "<" + feature2spec_token[f] + "_" + str(f_dict[feature2spec_token[f]]) + "> "
+                           for f in features_allowed if feature2spec_token[f] in f_dict}
+            for key, new_file in out_files.items():
+                line = "".join(spec_tokens[f] for f in key) + sentence + "\n"
+                new_file.write(line)
+                if has_sidecar:
+                    line_lengths[key].append(len(line.encode("utf-8")))
+            n_lines += 1
+
+    if has_sidecar:
+        write_subset_sidecars(sidecar, out_paths, line_lengths, all_combinations)
+
+    tgt_file_path = input_dir / (split + target_suffix)
+    if tgt_file_path.exists():
+        for combi in all_combinations:
+            link_or_copy(tgt_file_path, output_dir / "_".join(combi) / (split + target_suffix))
+    return split, n_lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", required=False, default="en", help="language of the corpus, 'en' or 'de'")
+    parser.add_argument("--input-dir", required=False, default=None,
+                        help="directory with the corpus preprocessed with all 4 features, default "
+                             "data_preprocessed/[lang]/dependency_frequency_length_levenshtein")
+    parser.add_argument("--workers", type=int, required=False, default=len(splits_allowed),
+                        help="number of splits processed in parallel")
+    args = vars(parser.parse_args())
+
+    if args["input_dir"] is not None:
+        path_to_4features_dir = Path(args["input_dir"])
+    else:
+        path_to_4features_dir = get_data_preprocessed_dir(args["lang"]) / "_".join(features_allowed)
+    # the feature combination directories are siblings of the 4-feature directory
+    data_dir = path_to_4features_dir.resolve().parent
+
+    all_combinations = create_f_combinations(features_allowed)
+    for combi in all_combinations:
+        make_path_make_dir(combi, data_dir)
+
+    split_args = [(split, path_to_4features_dir, data_dir, all_combinations) for split in splits_allowed]
+    with Pool(processes=max(1, min(args["workers"], len(split_args)))) as pool:
+        for split, n_lines in pool.starmap(fan_out_split, split_args):
+            print("... Wrote %d lines of %s into %d feature combinations in %s"
+                  % (n_lines, split, len(all_combinations), str(data_dir)))
@@ -0,0 +1,47 @@
+"""
+Serve the model of an experiment over HTTP on the local machine, see generation/server.py for the endpoints
+
+python serve.py --experiment-id 03 --language en --beam 8 --port 8080
+curl -s localhost:8080/rewrite -d '{"sentences": ["A long sentence."], "features": {"length": 0.75}}'
+curl -s localhost:8080/stats
+"""
+
+import argparse
+import os
+import sys
+from generation.rewriter import Rewriter
+from generation.server import MicroBatcher, RewriteServer, rewrite_best
+from utils.paths import get_experiment_dir
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment-id", required=True, help="ID of the experiment, checkpoint_best.pt will be used")
+parser.add_argument("--language", required=True, help="the language of input text, options: en, de")
+parser.add_argument("--beam", required=False, help="beam size, default 8", default=8, type=int)
+parser.add_argument("--spacy", action='store_true', required=False, help="set to True if spacy tokenizer should be used")
+parser.add_argument("--dict-dir", required=False,
+                    help="dir with the dict.src.txt and dict.tgt.txt files of the model, default: the checkpoints dir")
+parser.add_argument("--host", required=False, default="127.0.0.1", help="address to listen on, default 127.0.0.1")
+parser.add_argument("--port", required=False, default=8080, type=int, help="port to listen on, default 8080")
+parser.add_argument("--max-batch-size", required=False, default=32, type=int,
+                    help="maximum number of sentences decoded together, default 32")
+parser.add_argument("--max-latency-ms", required=False, default=20, type=float,
+                    help="how long the first request of a batch waits for further requests, default 20 ms")
+args = vars(parser.parse_args())
+
+model_dir = get_experiment_dir(args["experiment_id"]) / "checkpoints"
+model_path = model_dir / "checkpoint_best.pt"
+if not os.path.exists(model_path):
+    sys.exit("Error: This model does not exist " + str(model_path))
+
+tokenizer = "spacy" if args["spacy"] else "sentpiece"
+print("... Loading the model %s" % str(model_path))
+rewriter = Rewriter(model_path, args["dict_dir"] or model_dir, args["language"], beam=args["beam"],
+                    tokenizer_type=tokenizer, batch_size=args["max_batch_size"])
+batcher = MicroBatcher(rewrite_best(rewriter), max_batch_size=args["max_batch_size"],
+                       max_latency=args["max_latency_ms"] / 1000)
+server = RewriteServer((args["host"], args["port"]), batcher, rewriter.control_prefix)
+print("... Serving on http://%s:%d (POST /rewrite, GET /stats)" % (args["host"], args["port"]))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    server.server_close()
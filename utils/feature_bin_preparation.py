@@ -18,3 +18,40 @@ def create_bins():
     return {"frequency": frequency_bins, "dependency": dependency_bins, "length": length_bins,
              "levenshtein": levenshtein_bins}
 
+
+def bin_indices(values, this_feature_bins):
+    """ Map an array of raw feature values to the indices of their bins (np.digitize with right=True).
+    Values bigger than the last bin are clamped into the last bin """
+    idx = np.digitize(np.asarray(values, dtype=np.float64), this_feature_bins, right=True)
+    return np.minimum(idx, len(this_feature_bins) - 1)
+
+
+class FeatureBins:
+    """
+    The bins of all features, built once, and the mapping of whole columns of raw feature values to bin values and
+    bin indices. Indexing by feature name returns the bin edges, like the dictionary returned by create_bins().
+    """
+    def __init__(self, bins=None):
+        self.bins = create_bins() if bins is None else bins
+
+    def __getitem__(self, feature):
+        return self.bins[feature]
+
+    def __contains__(self, feature):
+        return feature in self.bins
+
+    def bin_indices(self, feature, values):
+        return bin_indices(values, self.bins[feature])
+
+    def bin_values(self, feature, values):
+        return self.bins[feature][self.bin_indices(feature, values)]
+
+
+_feature_bins = []
+
+
+def get_feature_bins():
+    """ Return the FeatureBins shared by all callers in this process """
+    if not _feature_bins:
+        _feature_bins.append(FeatureBins())
+    return _feature_bins[0]
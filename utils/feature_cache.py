@@ -0,0 +1,86 @@
+"""
+Persistent, content-addressed cache of exact feature values, shared by all preprocessing runs.
+
+Every value is stored in a SQLite database under a hash of (source, target, language, feature name, versions of
+the models the feature depends on). Re-running the preprocessing on the same corpus with another feature subset,
+tokenizer or split only computes the values that are not in the cache yet.
+"""
+
+import hashlib
+import sqlite3
+import spacy
+from utils.nlp_models import get_spacy_meta
+from utils.prepare_word_embeddings_frequency_ranks import get_ranks_version
+
+# bump the version of a feature when the way it is calculated changes, this invalidates its cached values
+FEATURE_VERSIONS = {"dependency": "1", "frequency": "1", "length": "1", "levenshtein": "1"}
+
+# SQLite allows at most 999 variables per statement in older versions
+MAX_KEYS_PER_QUERY = 500
+
+
+def feature_model_version(feature, lang, _freq_ranks=None):
+    """ Return a string that identifies the feature implementation and the models the feature value depends on """
+    version = [feature, FEATURE_VERSIONS[feature]]
+    if feature in {"dependency", "frequency"}:
+        meta = get_spacy_meta(lang)
+        version += [spacy.__version__, meta.get("name", ""), meta.get("version", "")]
+    if feature == "frequency":
+        version.append("ranks-" + get_ranks_version(_freq_ranks))
+    return "|".join(version)
+
+
+class FeatureCache:
+    """
+    A SQLite table of exact feature values. The connection is opened lazily and re-opened after pickling, so that
+    every worker process uses its own connection to the same database file.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._connection = None
+        self._versions = {}
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=120)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS features (key BLOB PRIMARY KEY, value REAL NOT NULL)")
+            self._connection.commit()
+        return self._connection
+
+    def key(self, source, target, lang, feature, _freq_ranks=None):
+        version_key = (feature, lang, id(_freq_ranks))
+        if version_key not in self._versions:
+            self._versions[version_key] = feature_model_version(feature, lang, _freq_ranks)
+        content = "\x1f".join([source, target, lang, self._versions[version_key]])
+        return hashlib.sha1(content.encode("utf-8")).digest()
+
+    def get_many(self, keys):
+        """ Return a dictionary key: value for all keys that are in the cache """
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), MAX_KEYS_PER_QUERY):
+            chunk = keys[i:i + MAX_KEYS_PER_QUERY]
+            query = "SELECT key, value FROM features WHERE key IN (%s)" % ",".join("?" * len(chunk))
+            for key, value in self.connection.execute(query, chunk):
+                found[bytes(key)] = value
+        return found
+
+    def put_many(self, items):
+        """ Store an iterable of (key, value) tuples """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO features (key, value) VALUES (?, ?)",
+                                        ((key, float(value)) for key, value in items))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
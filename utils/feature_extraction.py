@@ -7,54 +7,132 @@ List of features supported:
 
 """
 
-import spacy
 import numpy as np
 import string
 import re
+from collections import OrderedDict
+from itertools import islice, zip_longest
 import Levenshtein
 from nltk.corpus import stopwords
+from spacy.attrs import HEAD, ORTH
 #from utils.prepare_word_embeddings_frequency_ranks import load_ranks
-from utils.feature_bin_preparation import create_bins
+from utils.feature_bin_preparation import FeatureBins, bin_indices
+from utils.nlp_models import get_spacy_model, get_spacy_tokenizer
 
+# features that need a spacy parse of the source and target sentence
+PARSED_FEATURES = {"dependency", "frequency"}
+# order of the features in the bundles
+FEATURE_ORDER = ["frequency", "dependency", "length", "levenshtein"]
 
-def walk_tree(node, depth):
-    """ Pass a spacy root of a sentence, return the maximum length """
-    if node.n_lefts + node.n_rights > 0:
-        return max(walk_tree(child, depth + 1) for child in node.children)
-    else:
-        return depth
+IS_INT_OR_FLOAT = re.compile(r"^[+-]?((\d+(\.\d+)?)|(\.\d+))$")  # should match with "1", "3.68", but NOT "3s1"
 
+# maximum number of sentences whose absolute dependency and frequency values are memoized, see analyze_pairs
+SIDE_MEMO_SIZE = 200000
 
-def maximum_dependency_length(s, t, lang, absolute):
+# per-process caches, see get_stopwords, get_token_frequency_cache and get_side_feature_memo
+_stopword_sets = {}
+_token_frequency_caches = {}
+_side_feature_memos = {}
+
+
+def max_dependency_depths(docs):
+    """
+    Return a numpy array with the maximum dependency tree depth of every parsed spacy Doc in docs.
+    The depths are computed from the head indices of all tokens of all Docs at once, without recursion: in every
+    iteration all tokens that have not reached their root yet move one step up to their head.
+    The root of a sentence has depth 0, so single word sentences (and empty Docs) get depth 0.
+    """
+    docs = list(docs)
+    lengths = np.array([len(doc) for doc in docs], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    n_tokens = int(lengths.sum())
+    if n_tokens == 0:
+        return np.zeros(len(docs), dtype=np.int64)
+
+    # HEAD is stored relative to the token (as unsigned ints), make it an absolute index into the whole batch
+    token_ids = np.arange(n_tokens, dtype=np.int64)
+    relative_heads = np.concatenate([doc.to_array(HEAD).view(np.int64) for doc in docs if len(doc)])
+    heads = token_ids + relative_heads
+
+    depths = np.zeros(n_tokens, dtype=np.int64)
+    active = token_ids[heads != token_ids]  # tokens that are not a root
+    current = heads[active]
+    steps = 0
+    while active.size:
+        steps += 1
+        if steps > n_tokens:
+            raise ValueError("The dependency heads contain a cycle")
+        depths[active] = steps
+        not_root = heads[current] != current
+        active = active[not_root]
+        current = heads[current[not_root]]
+
+    max_depths = np.zeros(len(docs), dtype=np.int64)
+    non_empty = lengths > 0
+    max_depths[non_empty] = np.maximum.reduceat(depths, starts[non_empty])
+    return max_depths
+
+
+class SentencePairAnalysis:
+    """
+    A source and target sentence pair together with their spacy parses (one Doc per side).
+    Each side is parsed at most once, on first access, and the Doc is shared by all feature extractors.
+    Already parsed Docs can be passed in, e.g. from a batched nlp.pipe call.
+    """
+    def __init__(self, source, target, lang, source_doc=None, target_doc=None):
+        self.source = source
+        self.target = target
+        self.lang = lang
+        self._source_doc = source_doc
+        self._target_doc = target_doc
+        # maximum dependency depths, computed on first access or set for a whole batch by analyze_pairs
+        self.source_depth = None
+        self.target_depth = None
+        # third quantiles of the log frequency ranks, set for a whole batch by analyze_pairs
+        self.source_frequency = None
+        self.target_frequency = None
+        # Levenshtein ratio of the pair, set for a whole batch by analyze_pairs
+        self.levenshtein = None
+
+    @property
+    def source_doc(self):
+        if self._source_doc is None:
+            self._source_doc = get_spacy_model(self.lang)(self.source)
+        return self._source_doc
+
+    @property
+    def target_doc(self):
+        if self._target_doc is None:
+            self._target_doc = get_spacy_model(self.lang)(self.target)
+        return self._target_doc
+
+
+def max_dependency_depth(doc):
+    """ Return the maximum dependency tree depth over all sentences in a parsed spacy Doc """
+    return int(max_dependency_depths([doc])[0])
+
+
+def maximum_dependency_length(s, t, lang, absolute, pair=None):
     """ Language-dependent, language model loaded from spacy, parse
     Calculate the maximum dependency length of the SOURCE (complex) and divide it by that of TARGET (simple)
+    pair: optional SentencePairAnalysis of s and t, its Docs are reused instead of parsing again
     """
-    lang_model = {"en": "en_core_web_sm", "de": "de_core_news_sm"}
-    if lang.lower() not in lang_model:
-        print("Language choice not supported, defaulting to English (other option: German)")
-        lang = "en"
-
-    nlp_model = spacy.load(lang_model[lang])
-    doc = nlp_model(t)  # target
-    #all_depths = [walk_tree(sent.root, 0) for sent in doc.sents]
-    #print(all_depths)
-    max_depth_target = max([walk_tree(sent.root, 0) for sent in doc.sents])
+    if pair is None:
+        pair = SentencePairAnalysis(s, t, lang)
+    if pair.target_depth is None:
+        pair.target_depth = max_dependency_depth(pair.target_doc)
+    max_depth_target = pair.target_depth
 
     if absolute:
         return max_depth_target
 
-    doc = nlp_model(s)  # source
-    #all_depths = [walk_tree(sent.root, 0) for sent in doc.sents]
-    #print(all_depths)
-    max_depth_source = max([walk_tree(sent.root, 0) for sent in doc.sents])
+    if pair.source_depth is None:
+        pair.source_depth = max_dependency_depth(pair.source_doc)
+    max_depth_source = pair.source_depth
 
     if max_depth_source == 0:  # single word sentences...
-        #print("source depth 0??")
-        #import pdb; pdb.set_trace()
         max_depth_source = 0.5
     if max_depth_target == 0:
-        #print("target depth 0??")
-        #import pdb; pdb.set_trace()
         max_depth_target = 0.5
     depth_ratio = max_depth_target / max_depth_source
 
@@ -78,6 +156,17 @@ def Levenshtein_ratio(c, s):
     return Levenshtein.ratio(c, s)
 
 
+def Levenshtein_ratios(sources, targets):
+    """ Levenshtein_ratio for every pair of the aligned lists sources and targets, returned as a numpy array.
+    The pairs are scored one by one on a single core, mapped over the C function directly into the array.
+    Scoring in parallel is not possible with the pinned versions: the scorers of rapidfuzz 2.0 (the last version for
+    Python 3.6) hold the GIL, and process.cpdist needs rapidfuzz >= 3.6 and Python >= 3.8. preprocess.py --workers
+    spreads the chunks, and with them the Levenshtein ratios, over several processes.
+    """
+    assert len(sources) == len(targets), "Sources and targets don't have the same number of sentences"
+    return np.fromiter(map(Levenshtein.ratio, sources, targets), dtype=np.float64, count=len(sources))
+
+
 def get_freq_rank_word(word, ranks_dict):
     """ If the words in is vocabulary, return its rank (int), else return the very final rank """
     if word in ranks_dict:
@@ -101,20 +190,22 @@ def word_checks(token):
     :return: Boolean
     This function check if the token is a punctuation symbol or a number. If any of the two, return False
     """
-    is_int_or_float = re.compile(r"^[+-]?((\d+(\.\d+)?)|(\.\d+))$")  # should match with "1", "3.68", but NOT "3s1"
     if token in string.punctuation:
         return False
-    if is_int_or_float.match(token):
+    if IS_INT_OR_FLOAT.match(token):
         return False
     return True
 
 
+def get_stopwords(lang):
+    """ Return the NLTK stopwords of lang as a set, read in once per process """
+    if lang not in _stopword_sets:
+        _stopword_sets[lang] = frozenset(stopwords.words("german" if lang == "de" else "english"))
+    return _stopword_sets[lang]
+
+
 def stop_word_check(token, lang):
-    if lang == "de":
-        _stopwords = stopwords.words("german")
-    else:
-        _stopwords = stopwords.words("english")
-    if token in _stopwords:
+    if token in get_stopwords(lang):
         return False
     return True
 
@@ -129,107 +220,295 @@ def properties_word_freq_in_sentence(frequency_ranks, all_ranks):
     #mode = round(np.max(frequency_ranks), 2)
     #sd = np.std(frequency_ranks)
     #medi = np.median(frequency_ranks)
-    if not frequency_ranks:  # if the list of ranks is emtpy because all words were numbers or stopwords or punct.
-        frequency_ranks = [get_log_freq_rank_word("-NO-WORDS-", all_ranks)]
+    # if the list of ranks is emtpy because all words were numbers or stopwords or punct., see third_quantiles
+    return third_quantiles(frequency_ranks, [0, len(frequency_ranks)], all_ranks)[0]
 
-    #first_quantile = np.quantile(frequency_ranks, 0.25)
-    third_quantile = np.quantile(frequency_ranks, 0.75)
-    #q3q1 = third_quantile - first_quantile
 
-    # print("Mean %f, Mode %f, Median %f, SD %f, Q1 %f, Q3 %f, Q3-Q1 %f" % (mu, mode, medi, sd, first_quantile,
-    #                                                                       third_quantile, q3q1))
-    return third_quantile
+def third_quantiles(flat_frequency_ranks, offsets, all_ranks):
+    """
+    Batched version of properties_word_freq_in_sentence for many sentences at once
+    :param flat_frequency_ranks: the frequency ranks of all sentences concatenated into one flat array
+    :param offsets: sentence i has the ranks flat_frequency_ranks[offsets[i]:offsets[i+1]], len(offsets) = n + 1
+    :param all_ranks: a dictionary of ranks of word frequencies
+    :return: a numpy array with the third quantile of every sentence, the log rank of "-NO-WORDS-" for sentences
+    without any considered words
+    Sentences with the same number of ranks are stacked into a matrix and reduced with a single np.quantile call,
+    so the values are exactly those of np.quantile on every single sentence.
+    """
+    flat_frequency_ranks = np.asarray(flat_frequency_ranks, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    starts = offsets[:-1]
 
+    quantiles = np.empty(len(counts), dtype=np.float64)
+    quantiles[counts == 0] = get_log_freq_rank_word("-NO-WORDS-", all_ranks)
+    for count in np.unique(counts[counts > 0]):
+        rows = np.flatnonzero(counts == count)
+        matrix = flat_frequency_ranks[starts[rows, None] + np.arange(count)]
+        quantiles[rows] = np.quantile(matrix, 0.75, axis=1)
+    return quantiles
 
-def word_frequency_rank(source, target, lang, _ranks, absolute):
+
+class TokenFrequencyCache:
+    """
+    Properties of every lexeme that the frequency feature needs, keyed by the spacy orth ID of the token text:
+    the log frequency rank, or NaN if the token is skipped (punctuation, number or stopword).
+    The cache is filled lazily, so the checks and the rank lookup run once per distinct word in the whole run
+    instead of once per token, and a sentence becomes a gather of cached values.
+    """
+    def __init__(self, lang, _ranks):
+        self.lang = lang
+        self.ranks = _ranks
+        self._log_ranks = {}
+
+    def _compute(self, text):
+        if word_checks(text) and stop_word_check(text, self.lang):
+            return float(get_log_freq_rank_word(text, self.ranks))
+        return np.nan
+
+    def sentence_log_ranks(self, doc):
+        """ Return a numpy array with the log frequency ranks of the considered tokens in doc, in token order """
+        log_ranks = self._log_ranks
+        orths = doc.to_array(ORTH).tolist()
+        for orth, token in zip(orths, doc):
+            if orth not in log_ranks:
+                log_ranks[orth] = self._compute(token.text)
+        values = np.array([log_ranks[orth] for orth in orths], dtype=np.float64)
+        return values[~np.isnan(values)]
+
+
+def get_token_frequency_cache(lang, _ranks):
+    """ Return the TokenFrequencyCache for lang and these ranks, shared by all calls in this process.
+    There is one cache per language, it is replaced when other ranks are passed (load_ranks returns the same ranks
+    until the rank files change) """
+    cache = _token_frequency_caches.get(lang)
+    if cache is None or cache.ranks is not _ranks:
+        cache = _token_frequency_caches[lang] = TokenFrequencyCache(lang, _ranks)
+    return cache
+
+
+def sentence_frequency_ranks(doc, lang, _ranks):
+    """ Return the log frequency ranks of the tokens in a parsed spacy Doc,
+    ignoring punctuation and numbers as well as stopwords """
+    return get_token_frequency_cache(lang, _ranks).sentence_log_ranks(doc)
+
+
+def word_frequency_rank(source, target, lang, _ranks, absolute, pair=None):
     """
     Each word is associated with a frequency, For a sentence we get a distribution of frequencies.
     Properties of a distribution: mean, standard dev, quartiles
     Think about using log of the frequency rank
+    pair: optional SentencePairAnalysis of source and target, its Docs are reused instead of parsing again
     """
-    # step 0: load the rank dictionary
-    #ranks = load_ranks(lang)
-
-    # step 1: tokenize
-    lang_model = {"en": "en_core_web_sm", "de": "de_core_news_sm"}
-    if lang.lower() not in lang_model:
-        print("Language choice not supported, defaulting to English (other option: German (de))")
-        lang = "en"
-
-    nlp_model = spacy.load(lang_model[lang])
-    doc_target = nlp_model(target)
+    # step 1: tokenize, each side of the pair is parsed at most once
+    if pair is None:
+        pair = SentencePairAnalysis(source, target, lang)
 
     # step 2: get the (log) frequency rank for each token, observe for entire sentence
     # but ignore punctuation and numbers as well as stopwords
-    considered_tokens = [w.text for w in doc_target if word_checks(w.text) and stop_word_check(w.text, lang)]
-    # target_ranks = [get_freq_rank_word(w.text, ranks) for w in doc if word_checks(w.text) and
-    #                 stop_word_check(w.text, lang)]
-    target_ranks = [get_log_freq_rank_word(w.text, _ranks) for w in doc_target if word_checks(w.text) and
-                    stop_word_check(w.text, lang)]
-    third_quantile_target = properties_word_freq_in_sentence(target_ranks, _ranks)
+    if pair.target_frequency is None:
+        target_ranks = sentence_frequency_ranks(pair.target_doc, lang, _ranks)
+        pair.target_frequency = properties_word_freq_in_sentence(target_ranks, _ranks)
+    third_quantile_target = pair.target_frequency
 
     if absolute:
         return third_quantile_target
     # repeat the process for the source and return the ratio
-    doc_source = nlp_model(source)
-    source_ranks = [get_log_freq_rank_word(w.text, _ranks) for w in doc_source if word_checks(w.text) and
-                    stop_word_check(w.text, lang)]
-    third_quantile_source = properties_word_freq_in_sentence(source_ranks, _ranks)
+    if pair.source_frequency is None:
+        source_ranks = sentence_frequency_ranks(pair.source_doc, lang, _ranks)
+        pair.source_frequency = properties_word_freq_in_sentence(source_ranks, _ranks)
+    third_quantile_source = pair.source_frequency
 
     return third_quantile_target / third_quantile_source
 
 
-def feature_bundle_sentence(source, target, lang, list_of_desired_features, _freq_ranks):
+def feature_bundle_pair(pair, list_of_desired_features, _freq_ranks):
+    """ Calculate the exact values of the desired features for a SentencePairAnalysis.
+    All features share the pair's Docs, so each sentence is parsed at most once """
     bundle = {}
     if "frequency" in list_of_desired_features:
-        v = word_frequency_rank(source, target, lang, _freq_ranks, absolute=False)
-        bundle["frequency"] = v
+        bundle["frequency"] = word_frequency_rank(pair.source, pair.target, pair.lang, _freq_ranks, absolute=False,
+                                                  pair=pair)
     if "dependency" in list_of_desired_features:
-        v = maximum_dependency_length(source, target, lang, absolute=False)
-        bundle["dependency"] = v
+        bundle["dependency"] = maximum_dependency_length(pair.source, pair.target, pair.lang, absolute=False,
+                                                         pair=pair)
     if "length" in list_of_desired_features:
-        v = character_length_ratio(source, target, absolute=False)
-        bundle["length"] = v
+        bundle["length"] = character_length_ratio(pair.source, pair.target, absolute=False)
     if "levenshtein" in list_of_desired_features:
-        v = Levenshtein_ratio(source, target)
-        bundle["levenshtein"] = v
+        if pair.levenshtein is None:
+            pair.levenshtein = Levenshtein_ratio(pair.source, pair.target)
+        bundle["levenshtein"] = pair.levenshtein
     return bundle
 
 
+def feature_bundle_sentence(source, target, lang, list_of_desired_features, _freq_ranks, feature_cache=None):
+    return feature_bundles_batch([(source, target)], lang, list_of_desired_features, _freq_ranks, feature_cache)[0]
+
+
 def get_bin_value(x_val, this_feature_bins):
-    # using numpy digitize
-    idx = np.digitize([x_val], this_feature_bins, right=True).item()
-    if idx == len(this_feature_bins):  # the idx is out of range if the value is bigger than the last bin
-        idx -= 1
+    # using numpy digitize, the idx is clamped to the last bin if the value is bigger than the last bin
+    idx = bin_indices([x_val], this_feature_bins)[0]
     return this_feature_bins[idx]
 
 
-def feature_bins_bundle_sentence(source, target, lang, list_of_desired_features, feature_bin_dictionary, _freq_ranks):
-    bundle = {}
-    bundle_exact = {}
-    if "frequency" in list_of_desired_features:
-        v = word_frequency_rank(source, target, lang, _freq_ranks, absolute=False)
-        v_bin = get_bin_value(v, feature_bin_dictionary["frequency"])
-        bundle["frequency"] = v_bin
-        bundle_exact["frequency"] = v
-    if "dependency" in list_of_desired_features:
-        v = maximum_dependency_length(source, target, lang, absolute=False)
-        v_bin = get_bin_value(v, feature_bin_dictionary["dependency"])
-        bundle["dependency"] = v_bin
-        bundle_exact["dependency"] = v
-    if "length" in list_of_desired_features:
-        v = character_length_ratio(source, target, absolute=False)
-        v_bin = get_bin_value(v, feature_bin_dictionary["length"])
-        bundle["length"] = v_bin
-        bundle_exact["length"] = v
-    if "levenshtein" in list_of_desired_features:
-        v = Levenshtein_ratio(source, target)
-        v_bin = get_bin_value(v, feature_bin_dictionary["levenshtein"])
-        bundle["levenshtein"] = v_bin
-        bundle_exact["levenshtein"] = v
+def feature_bins_bundle_sentence(source, target, lang, list_of_desired_features, feature_bin_dictionary, _freq_ranks,
+                                 feature_cache=None):
+    """ feature_cache: optional FeatureCache (utils/feature_cache.py), consulted before anything is computed """
+    bundle_exact = feature_bundle_sentence(source, target, lang, list_of_desired_features, _freq_ranks, feature_cache)
+    bundle = {f: get_bin_value(v, feature_bin_dictionary[f]) for f, v in bundle_exact.items()}
     return bundle, bundle_exact
 
 
+def yield_pair_batches(sources, targets, batch_size):
+    """ Yield lists of at most batch_size (source, target) tuples from the iterables sources and targets """
+    pair_iterator = zip_longest(sources, targets)
+    while True:
+        batch = list(islice(pair_iterator, batch_size))
+        if not batch:
+            break
+        for s, t in batch:
+            assert s is not None and t is not None, "Sources and targets don't have the same number of sentences"
+        yield batch
+
+
+class LRUMemo:
+    """ A dictionary with at most max_size entries, the least recently used entry is evicted first """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        if key not in self._values:
+            return default
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def put(self, key, value):
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+
+def get_side_feature_memo(lang, _freq_ranks=None):
+    """ Return the LRUMemo of absolute per-sentence feature values for lang and these ranks, shared by all calls in
+    this process. As the token frequency caches there is one memo per language, replaced when other ranks are
+    passed """
+    memo, ranks = _side_feature_memos.get(lang, (None, None))
+    if memo is None or ranks is not _freq_ranks:
+        memo = LRUMemo(SIDE_MEMO_SIZE)
+        _side_feature_memos[lang] = (memo, _freq_ranks)
+    return memo
+
+
+def analyze_pairs(batch, lang, list_of_desired_features, _freq_ranks=None):
+    """
+    Return a SentencePairAnalysis for every (source, target) tuple in batch, in input order.
+    The dependency and frequency ratios are built from absolute values of each side (maximum depth, third quantile
+    of the log frequency ranks). These absolute values are memoized per unique sentence (see get_side_feature_memo),
+    so a sentence that occurs in several pairs, e.g. a source with several targets or the gold source of several
+    system outputs, is parsed and analyzed once. The remaining sentences of the batch are parsed together with
+    nlp.pipe, which is several times faster than calling the spacy model for each sentence. Nothing is parsed if no
+    requested feature needs it, and the frequency feature alone only needs the tokens: then the sentences are just
+    tokenized, without the parser. The Levenshtein ratios are computed for the whole batch.
+    """
+    n = len(batch)
+    texts = [s for s, _ in batch] + [t for _, t in batch]
+
+    side_features = [f for f in ["dependency", "frequency"] if f in list_of_desired_features]
+    if _freq_ranks is None and "frequency" in side_features:
+        side_features.remove("frequency")  # computed lazily by word_frequency_rank
+    memo = get_side_feature_memo(lang, _freq_ranks)
+    side_values = {(f, text): memo.get((f, text)) for f in side_features for text in texts}
+
+    # parse every distinct sentence with a missing absolute value once
+    to_parse = list(OrderedDict.fromkeys(text for (f, text), v in side_values.items() if v is None))
+    docs_by_text = {}
+    if to_parse:
+        nlp = get_spacy_model(lang) if "dependency" in side_features else get_spacy_tokenizer(lang)
+        parsed_docs = list(nlp.pipe(to_parse, batch_size=len(to_parse)))
+        docs_by_text = dict(zip(to_parse, parsed_docs))
+        if "dependency" in side_features:
+            for text, depth in zip(to_parse, max_dependency_depths(parsed_docs)):
+                side_values[("dependency", text)] = int(depth)
+        if "frequency" in side_features:
+            sentence_ranks = [sentence_frequency_ranks(doc, lang, _freq_ranks) for doc in parsed_docs]
+            offsets = np.concatenate([[0], np.cumsum([len(r) for r in sentence_ranks])])
+            frequencies = third_quantiles(np.concatenate(sentence_ranks), offsets, _freq_ranks)
+            for text, frequency in zip(to_parse, frequencies):
+                side_values[("frequency", text)] = frequency
+        for text in to_parse:
+            for f in side_features:
+                memo.put((f, text), side_values[(f, text)])
+
+    pairs = [SentencePairAnalysis(s, t, lang, source_doc=docs_by_text.get(s), target_doc=docs_by_text.get(t))
+             for s, t in batch]
+    for pair in pairs:
+        if "dependency" in side_features:
+            pair.source_depth = side_values[("dependency", pair.source)]
+            pair.target_depth = side_values[("dependency", pair.target)]
+        if "frequency" in side_features:
+            pair.source_frequency = side_values[("frequency", pair.source)]
+            pair.target_frequency = side_values[("frequency", pair.target)]
+    if "levenshtein" in list_of_desired_features:
+        ratios = Levenshtein_ratios(texts[:n], texts[n:])
+        for pair, ratio in zip(pairs, ratios):
+            pair.levenshtein = float(ratio)
+    return pairs
+
+
+def feature_bundles_batch(batch, lang, list_of_desired_features, _freq_ranks, feature_cache=None):
+    """
+    Return the exact feature values (bundle_exact) for every (source, target) tuple in batch, in input order.
+    If a FeatureCache is given, all values are looked up first and only the missing ones are computed (and then
+    stored), so pairs with only cached values are not even parsed.
+    """
+    if feature_cache is None:
+        pairs = analyze_pairs(batch, lang, list_of_desired_features, _freq_ranks)
+        return [feature_bundle_pair(pair, list_of_desired_features, _freq_ranks) for pair in pairs]
+
+    keys = [{f: feature_cache.key(s, t, lang, f, _freq_ranks) for f in list_of_desired_features} for s, t in batch]
+    cached = feature_cache.get_many(k for pair_keys in keys for k in pair_keys.values())
+    bundles = [{f: cached[k] for f, k in pair_keys.items() if k in cached} for pair_keys in keys]
+
+    missing = [i for i, bundle in enumerate(bundles) if len(bundle) < len(keys[i])]
+    if missing:
+        missing_features = [f for f in list_of_desired_features if any(f not in bundles[i] for i in missing)]
+        pairs = analyze_pairs([batch[i] for i in missing], lang, missing_features, _freq_ranks)
+        new_values = []
+        for i, pair in zip(missing, pairs):
+            computed = feature_bundle_pair(pair, [f for f in missing_features if f not in bundles[i]], _freq_ranks)
+            bundles[i].update(computed)
+            new_values.extend((keys[i][f], v) for f, v in computed.items())
+        feature_cache.put_many(new_values)
+
+    # same order of the features as in feature_bundle_pair
+    return [{f: bundle[f] for f in FEATURE_ORDER if f in bundle} for bundle in bundles]
+
+
+def feature_bins_bundle_corpus(sources, targets, lang, list_of_desired_features, feature_bin_dictionary, _freq_ranks,
+                               batch_size=256, feature_cache=None):
+    """
+    Corpus-level counterpart of feature_bins_bundle_sentence.
+    sources, targets: iterables of sentences, e.g. lists or generators over the lines of a file
+    feature_cache: optional FeatureCache (utils/feature_cache.py), consulted before anything is computed
+    Yields (bundle, bundle_exact) for every sentence pair, in input order
+    """
+    if not isinstance(feature_bin_dictionary, FeatureBins):
+        feature_bin_dictionary = FeatureBins(feature_bin_dictionary)
+    for batch in yield_pair_batches(sources, targets, batch_size):
+        bundles_exact = feature_bundles_batch(batch, lang, list_of_desired_features, _freq_ranks, feature_cache)
+        # bin every feature for the whole batch at once
+        binned_columns = {f: feature_bin_dictionary.bin_values(f, [b[f] for b in bundles_exact])
+                          for f in bundles_exact[0]}
+        for i, bundle_exact in enumerate(bundles_exact):
+            bundle = {f: binned_columns[f][i] for f in bundle_exact}
+            yield bundle, bundle_exact
+
+
 #### TESTING ###
 
 features = ["frequency", "dependency", "length", "levenshtein"]
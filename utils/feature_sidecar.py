@@ -0,0 +1,155 @@
+"""
+Columnar sidecar of the feature values of a preprocessed source file
+
+Next to every preprocessed [split].src file, preprocess.py writes [split].features.npz with the columns:
+- features: the names of the extracted features, in the order of the columns below
+- exact: float32 (n_lines, n_features), the exact feature values
+- bins: uint8 (n_lines, n_features), the indices of the feature bins (see utils/feature_bin_preparation.py)
+- line_offsets: int64 (n_lines + 1), the byte offset of every line in the .src file and the file size
+
+Tools that need the feature values (inspection, evaluation, removing features) load these columns instead of
+parsing the <MaxDep_0.8> style tokens from the text.
+"""
+
+import os
+from array import array
+from pathlib import Path
+import numpy as np
+from utils.feature_bin_preparation import get_feature_bins
+from utils.shard_manifest import count_lines
+
+
+def get_sidecar_path(src_path):
+    """ train.src -> train.features.npz in the same directory """
+    src_path = Path(src_path)
+    return src_path.parent / (src_path.stem + ".features.npz")
+
+
+class FeatureSidecarWriter:
+    """ Collects the exact feature values and the byte length of every written source line.
+    With a spool_path, flush() appends the collected lines to that file, so a resumed preprocessing run
+    (preprocess.py --resume) continues the columns of the interrupted run """
+    def __init__(self, features, spool_path=None):
+        self.features = list(features)
+        self.spool_path = spool_path
+        self.spool_dtype = np.dtype([("exact", "<f8", (len(self.features),)), ("length", "<i8")])
+        self._exact = {f: array("d") for f in self.features}
+        self._line_lengths = array("q")
+
+    def __len__(self):
+        return len(self._line_lengths)
+
+    def add(self, f_vals_exact, written_line):
+        """ f_vals_exact: dict with the exact feature values, written_line: the line written into the .src file,
+        including the line break """
+        for f in self.features:
+            self._exact[f].append(f_vals_exact[f])
+        self._line_lengths.append(len(written_line.encode("utf-8")))
+
+    def _collected_records(self):
+        records = np.zeros(len(self._line_lengths), dtype=self.spool_dtype)
+        for j, f in enumerate(self.features):
+            records["exact"][:, j] = np.frombuffer(self._exact[f], dtype=np.float64)
+        records["length"] = np.frombuffer(self._line_lengths, dtype=np.int64)
+        return records
+
+    def flush(self):
+        """ Append the collected lines to the spool file, return its size in bytes """
+        with open(self.spool_path, "ab") as spool:
+            spool.write(self._collected_records().tobytes())
+            spool.flush()
+            os.fsync(spool.fileno())
+            size = spool.tell()
+        self._exact = {f: array("d") for f in self.features}
+        self._line_lengths = array("q")
+        return size
+
+    def records(self):
+        """ Return all lines added so far (including the spooled ones) as a numpy record array """
+        collected = self._collected_records()
+        if self.spool_path is None or not os.path.exists(self.spool_path):
+            return collected
+        return np.concatenate([np.fromfile(str(self.spool_path), dtype=self.spool_dtype), collected])
+
+    def exact_columns(self):
+        """ Return a dictionary feature: numpy array of the exact values of all lines """
+        exact = self.records()["exact"]
+        return {f: exact[:, j] for j, f in enumerate(self.features)}
+
+    def write(self, path):
+        feature_bins = get_feature_bins()
+        records = self.records()
+        exact = records["exact"].astype(np.float32)
+        bins = np.zeros((len(records), len(self.features)), dtype=np.uint8)
+        for j, f in enumerate(self.features):
+            bins[:, j] = feature_bins.bin_indices(f, records["exact"][:, j])
+        line_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        line_offsets[1:] = np.cumsum(records["length"])
+        write_sidecar(path, self.features, exact, bins, line_offsets)
+
+
+def line_lengths_to_offsets(line_lengths):
+    """ Turn the byte lengths of the lines (an array("q")) into the line_offsets column """
+    line_offsets = np.zeros(len(line_lengths) + 1, dtype=np.int64)
+    line_offsets[1:] = np.cumsum(np.frombuffer(line_lengths, dtype=np.int64))
+    return line_offsets
+
+
+def write_sidecar(path, features, exact, bins, line_offsets):
+    # write through a file object, np.savez would append .npz to a path with another suffix (e.g. a temp file)
+    with open(path, "wb") as f:
+        np.savez(f, features=np.array(list(features)), exact=exact, bins=bins, line_offsets=line_offsets)
+
+
+def load_sidecar(path):
+    """ Return a dictionary with the columns of the sidecar file at path """
+    with np.load(str(path)) as sidecar:
+        columns = {name: sidecar[name] for name in sidecar.files}
+    columns["features"] = [str(f) for f in columns["features"]]
+    return columns
+
+
+def sidecar_mismatch(columns, src_path):
+    """ Return why the sidecar columns do not describe the text file src_path, None if they do: every column needs a
+    row for every line of the file and the last line offset has to be the size of the file """
+    n_rows = len(columns["line_offsets"]) - 1
+    for name in ["exact", "bins"]:
+        if len(columns[name]) != n_rows:
+            return "%s has %d rows for %d line offsets" % (name, len(columns[name]), n_rows)
+    size = os.path.getsize(src_path)
+    if int(columns["line_offsets"][-1]) != size:
+        return "the line offsets end at byte %d, the file has %d bytes" % (int(columns["line_offsets"][-1]), size)
+    n_lines = count_lines(src_path)
+    if n_lines != n_rows:
+        return "%d rows for %d lines" % (n_rows, n_lines)
+    return None
+
+
+def load_matching_sidecar(src_path, sidecar_path=None):
+    """ Return the columns of the sidecar of src_path (default path: get_sidecar_path), or None if there is none or
+    if it does not match the text file, e.g. a sidecar left over from an earlier corpus. The feature values then have
+    to be parsed from the control tokens """
+    if sidecar_path is None:
+        sidecar_path = get_sidecar_path(src_path)
+    if not Path(sidecar_path).exists():
+        return None
+    columns = load_sidecar(sidecar_path)
+    mismatch = sidecar_mismatch(columns, src_path)
+    if mismatch is not None:
+        print("... Ignoring the feature sidecar %s, it does not match %s: %s" % (str(sidecar_path), str(src_path),
+                                                                                 mismatch))
+        return None
+    return columns
+
+
+def strip_control_tokens(line, n_features):
+    """ Remove the n_features control tokens that preprocess.py prepends to a source line """
+    parts = line.split(" ", n_features)
+    return parts[n_features] if len(parts) > n_features else ""
+
+
+def sidecar_bin_values(columns):
+    """ Return a dictionary feature: numpy array of the bin values as they are written in the control tokens,
+    i.e. rounded to 2 decimals """
+    feature_bins = get_feature_bins()
+    return {f: np.round(feature_bins[f][columns["bins"][:, j]], 2) for j, f in enumerate(columns["features"])}
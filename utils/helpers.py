@@ -1,16 +1,11 @@
 from contextlib import contextmanager, AbstractContextManager
-import sys
 import os
-from collections import defaultdict
-import re
 from pathlib import Path
-from itertools import zip_longest
-import spacy
+from itertools import zip_longest, islice
 import yaml
 import matplotlib.pyplot as plt
 from utils.paths import get_data_preprocessed_dir
-import sentencepiece as spm
-from .paths import get_data_auxiliary_dir
+from utils.nlp_models import get_spacy_tokenizer, get_sentencepiece_model
 
 feature2spec_token = {"dependency": "MaxDep", "frequency": "FreqRank", "length": "Length", "levenshtein": "Leven"}
 
@@ -45,6 +40,19 @@ def yield_lines_in_parallel(filepaths, strip=True, strict=True, n_lines=float('i
             yield parallel_lines
 
 
+def yield_batches_in_parallel(filepaths, batch_size, strip=True, strict=True, skip=0):
+    # like yield_lines_in_parallel, but yield a list of lines per file for every batch_size lines
+    # skip: number of lines at the beginning of the files that are not yielded (e.g. when resuming)
+    batch = []
+    for parallel_lines in islice(yield_lines_in_parallel(filepaths, strip=strip, strict=strict), skip, None):
+        batch.append(parallel_lines)
+        if len(batch) == batch_size:
+            yield [list(lines) for lines in zip(*batch)]
+            batch = []
+    if batch:
+        yield [list(lines) for lines in zip(*batch)]
+
+
 # f1, f2 = "a.complex", "a.simple"
 #
 # for x in yield_lines_in_parallel([f1, f2], strict=True):
@@ -75,15 +83,13 @@ def load_tokenizer(tokenizer_type, lang):
     if lang.lower() not in {"en", "de"}:
         print("Language choice not supported, defaulting to English (other option: German)")
 
+    # the models are loaded once per process and shared with the feature extraction
+    # spacy: only the tokenizer of the pipeline, tokenization never runs the parser
     if tokenizer_type == "spacy":
-        lang_models = {"de": "de_core_news_sm", "en": "en_core_web_sm"}
-        tokenizer_model = spacy.load(lang_models[lang])
+        tokenizer_model = get_spacy_tokenizer(lang)
 
     else:
-        model_dir = get_data_auxiliary_dir(lang)
-        lang_models = {"de": model_dir / "de.sp.model", "en": model_dir / "en.sp.model"}
-        tokenizer_model = spm.SentencePieceProcessor()
-        tokenizer_model.load(str(lang_models[lang]))
+        tokenizer_model = get_sentencepiece_model(lang)
 
     return tokenizer_model
 
@@ -99,39 +105,65 @@ def prepend_feature_to_string(original_source_string, original_target_string,
     # https://github.com/google/sentencepiece/blob/master/doc/special_symbols.md
     # Multiple files can be used to train it https://github.com/google/sentencepiece/issues/489
     # Use the train and val SRC and TGT
-
-    # mapping: feature: special_token
-    feature2spec_token = {"dependency": "MaxDep", "frequency": "FreqRank", "length": "Length", "levenshtein": "Leven"}
-
+    new_sources, new_targets = prepend_features_to_strings([original_source_string], [original_target_string],
+                                                           feature_list, [feature_value_dict], tokenizer_type,
+                                                           tokenizer_model)
+    return new_sources[0], new_targets[0]
+
+
+def prepend_features_to_strings(original_source_strings, original_target_strings,
+                                feature_list, feature_value_dicts, tokenizer_type, tokenizer_model, num_threads=-1):
+    """ Like prepend_feature_to_string for lists of sentence pairs, the sentences of a side are tokenized together
+    (for SentencePiece with num_threads threads, -1: as many as cores) """
+    source_tokens = tokenize_batch(original_source_strings, tokenizer_type, tokenizer_model, num_threads)
+    target_tokens = tokenize_batch(original_target_strings, tokenizer_type, tokenizer_model, num_threads)
+
+    new_sources, new_targets = [], []
+    for src_tokens, tgt_tokens, feature_value_dict in zip(source_tokens, target_tokens, feature_value_dicts):
+        to_be_prepended = ""
+        for f in feature_list:
+            to_be_prepended += get_control_token(f, feature_value_dict[f]) + " "
+        new_sources.append(to_be_prepended + " ".join(src_tokens))
+        new_targets.append(" ".join(tgt_tokens))
+    return new_sources, new_targets
+
+
+def tokenize_batch(strings, tokenizer_type, tokenizer_model, num_threads=-1):
+    """ Return a list of tokens for every string """
     if tokenizer_type == "spacy":
-        source_tokens = run_spacy_tokenizer(original_source_string, tokenizer_model)
-        target_tokens = run_spacy_tokenizer(original_target_string, tokenizer_model)
-    else:
-        source_tokens = run_sentencepiece_tokenizer(original_source_string, tokenizer_model)
-        target_tokens = run_sentencepiece_tokenizer(original_target_string, tokenizer_model)
+        return run_spacy_tokenizer_batch(strings, tokenizer_model)
+    return run_sentencepiece_tokenizer_batch(strings, tokenizer_model, num_threads)
 
-    to_be_prepended = ""
-    for f in feature_list:
-        v = str(round(feature_value_dict[f], 2))
-        prep = "<" + feature2spec_token[f] + "_" + v + "> "
-        to_be_prepended += prep
 
-    new_source = to_be_prepended + " ".join(source_tokens)
-    new_target = " ".join(target_tokens)
-
-    return new_source, new_target
+def get_control_token(feature, value):
+    """ Return the control token of a feature (bin) value, e.g. <MaxDep_0.8> """
+    return "<" + feature2spec_token[feature] + "_" + str(round(value, 2)) + ">"
 
 
 def run_spacy_tokenizer(original_string, spacy_model):
-    tokenized_string = [t.text for t in spacy_model(original_string) if t.text not in {" ", "  "}]
+    # spacy_model: a spacy tokenizer or pipeline, of a pipeline only the tokenizer is run
+    tokenizer = getattr(spacy_model, "tokenizer", spacy_model)
+    tokenized_string = [t.text for t in tokenizer(original_string) if t.text not in {" ", "  "}]
     return tokenized_string
 
 
+def run_spacy_tokenizer_batch(original_strings, spacy_model, batch_size=1000):
+    """ Like run_spacy_tokenizer for a list of strings, using the tokenizer's pipe """
+    tokenizer = getattr(spacy_model, "tokenizer", spacy_model)
+    return [[t.text for t in doc if t.text not in {" ", "  "}]
+            for doc in tokenizer.pipe(original_strings, batch_size=batch_size)]
+
+
 def run_sentencepiece_tokenizer(original_string, sentpiece_model):
     tokenized_string = sentpiece_model.encode_as_pieces(original_string)
     return tokenized_string
 
 
+def run_sentencepiece_tokenizer_batch(original_strings, sentpiece_model, num_threads=-1):
+    """ Encode a list of strings into pieces with one call on num_threads threads (-1: as many as cores) """
+    return sentpiece_model.encode(list(original_strings), out_type=str, num_threads=num_threads)
+
+
 def plot_histogram(x, feature_name, lang):
     n_bins = 80  # 50 in the binned version for NLG
     if feature_name in {"levenshtein"}:
@@ -155,34 +187,6 @@ def match_dir_with_features(list_allowed_features, list_requested_features):
     return d
 
 
-@contextmanager
-def log_stdout(filepath, mute_stdout=False):
-    """ Context manager to write both to stdout and to a file """
-    class MultipleStreamsWriter:
-        def __init__(self, streams):
-            self.streams = streams
-
-        def write(self, message):
-            for stream in self.streams:
-                stream.write(message)
-
-        def flush(self):
-            for stream in self.streams:
-                stream.flush()
-
-    save_stdout = sys.stdout
-    log_file = open(filepath, 'w')
-    if mute_stdout:
-        sys.stdout = MultipleStreamsWriter([log_file])  # Write to file only
-    else:
-        sys.stdout = MultipleStreamsWriter([save_stdout, log_file])  # Write to both stdout and file
-    try:
-        yield
-    finally:
-        sys.stdout = save_stdout
-        log_file.close()
-
-
 def yield_lines(filepath, n_lines=float('inf'), prop=1):
     # if prop < 1:
     #     assert n_lines == float('inf')
@@ -194,14 +198,3 @@ def yield_lines(filepath, n_lines=float('inf'), prop=1):
             yield l.rstrip('\n')
 
 
-def parse_model_hypotheses(filepath):
-    hypotheses_dict = defaultdict(list)
-    for line in yield_lines(filepath):
-        match = re.match(r'^H-(\d+)\t-?\d+\.\d+\t(.*)$', line)
-        if match:
-            sample_id, hypothesis = match.groups()
-            hypotheses_dict[int(sample_id)].append(hypothesis)
-    # Sort in original order
-    return [hypotheses_dict[i] for i in range(len(hypotheses_dict))]
-
-
@@ -0,0 +1,72 @@
+"""
+Process-wide registry of the NLP models used in preprocessing, evaluation and generation.
+
+Every spacy language pipeline and every SentencePiece model is loaded at most once per process, all callers
+share the same instance. The spacy pipelines are loaded without the components that none of the features or
+tokenizers use (e.g. NER), which makes both loading and parsing cheaper.
+"""
+
+import spacy
+import sentencepiece as spm
+from utils.paths import get_data_auxiliary_dir
+
+spacy_lang_models = {"en": "en_core_web_sm", "de": "de_core_news_sm"}
+
+# only the tokenizer, tok2vec and the parser are needed: tokens, sentence boundaries and dependency heads
+SPACY_EXCLUDED_COMPONENTS = ["ner", "lemmatizer", "attribute_ruler", "tagger", "morphologizer", "senter"]
+
+_spacy_models = {}
+_spacy_tokenizers = {}
+_spacy_metas = {}
+_sentencepiece_models = {}
+
+
+def check_lang(lang):
+    """ Return the lower-cased language, default to English if the language is not supported """
+    if lang.lower() not in spacy_lang_models:
+        print("Language choice not supported, defaulting to English (other option: German)")
+        return "en"
+    return lang.lower()
+
+
+def get_spacy_model(lang):
+    """ Load the spacy pipeline for lang on the first call, return the shared instance afterwards """
+    lang = check_lang(lang)
+    if lang not in _spacy_models:
+        _spacy_models[lang] = spacy.load(spacy_lang_models[lang], exclude=SPACY_EXCLUDED_COMPONENTS)
+    return _spacy_models[lang]
+
+
+def get_spacy_tokenizer(lang):
+    """ Return the tokenizer of the spacy pipeline for lang, without running any pipeline component. If the full
+    pipeline is loaded already its tokenizer is shared, else only the tokenizer and the vocabulary are loaded """
+    lang = check_lang(lang)
+    if lang in _spacy_models:
+        return _spacy_models[lang].tokenizer
+    if lang not in _spacy_tokenizers:
+        nlp = spacy.load(spacy_lang_models[lang], exclude=["tok2vec", "parser"] + SPACY_EXCLUDED_COMPONENTS)
+        _spacy_tokenizers[lang] = nlp.tokenizer
+        _spacy_metas[lang] = nlp.meta
+    return _spacy_tokenizers[lang]
+
+
+def get_spacy_meta(lang):
+    """ Return the meta data (name, version, ...) of the spacy pipeline for lang, the parser is not loaded for it """
+    lang = check_lang(lang)
+    if lang in _spacy_models:
+        return _spacy_models[lang].meta
+    get_spacy_tokenizer(lang)
+    return _spacy_metas[lang]
+
+
+def get_sentencepiece_model(lang):
+    """ Load the SentencePiece model in data_auxiliary/[lang] on the first call, return the shared instance
+    afterwards """
+    lang = check_lang(lang)
+    if lang not in _sentencepiece_models:
+        model_path = get_data_auxiliary_dir(lang) / (lang + ".sp.model")
+        sentpiece_model = spm.SentencePieceProcessor()
+        sentpiece_model.load(str(model_path))
+        _sentencepiece_models[lang] = sentpiece_model
+    return _sentencepiece_models[lang]
+
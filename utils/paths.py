@@ -19,6 +19,10 @@ evaluation_dir = Path(REPO_DIR) / "evaluation"
 splits = ["train", "valid", "test"]
 suffixes = ["src", "tgt"]
 features = ["dependency", "frequency", "length", "leven"]
+# directory in data_preprocessed/[lang] with the corpus preprocessed without control tokens (preprocess.py --plain-source)
+plain_source_dir_name = "plain"
+# directory next to the preprocessed text with the dictionaries and binarized datasets fairseq trains on
+fairseq_dir_name = "fairseq"
 
 
 def create_feature_combinations():
@@ -49,6 +53,19 @@ def get_data_preprocessed_dir(lang):
     return dir_path
 
 
+def get_plain_source_dir(lang):
+    return get_data_preprocessed_dir(lang) / plain_source_dir_name
+
+
+def get_fairseq_data_dir(preprocessed_dir):
+    return Path(preprocessed_dir) / fairseq_dir_name
+
+
+def get_binarized_dataset_prefix(fairseq_dir, split, suffix):
+    """ fairseq's name of a dataset, e.g. train.src-tgt.src, the mmap dataset adds .bin and .idx """
+    return Path(fairseq_dir) / f'{split}.src-tgt.{suffix}'
+
+
 def get_configs_dir(exp_id):
     return configs_dir / exp_id
 
@@ -131,6 +148,23 @@ def get_input_shardpath_dict(shard_name, lang):
 
 
 
+def binarized_datasets_exist(fairseq_dir):
+    """ True if fairseq_dir has the dictionaries and the mmap datasets of all splits (preprocess.py --binarize) """
+    paths = [Path(fairseq_dir) / f'dict.{suffix}.txt' for suffix in suffixes]
+    for split, suffix in product(splits, suffixes):
+        prefix = get_binarized_dataset_prefix(fairseq_dir, split, suffix)
+        paths += [Path(str(prefix) + ".bin"), Path(str(prefix) + ".idx")]
+    return all(path.exists() for path in paths)
+
+
+def remove_binarized_split(fairseq_dir, split):
+    """ Remove the mmap datasets of split, they are stale once the text of the split is written again """
+    for suffix, extension in product(suffixes, [".bin", ".idx"]):
+        path = Path(str(get_binarized_dataset_prefix(fairseq_dir, split, suffix)) + extension)
+        if path.exists():
+            path.unlink()
+
+
 def check_if_dir_exists_and_is_empty(dir_path):
     # if the path to dir exists, delete its contents
     if os.path.exists(dir_path):
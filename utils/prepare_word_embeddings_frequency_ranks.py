@@ -1,6 +1,16 @@
+import argparse
+import hashlib
 import json
+import mmap
+import os
+import numpy as np
 from utils.paths import get_data_auxiliary_dir
 
+RANK_STORE_PREFIX = "frequency_ranks"
+
+# the ranks loaded in this process per language, see load_ranks
+_loaded_ranks = {}
+
 
 def read_in_embeddings_return_frequency_rank_dict(path_to_embeddings):
     """
@@ -29,6 +39,95 @@ def read_in_embeddings_return_frequency_rank_dict(path_to_embeddings):
     return ranks
 
 
+class FrequencyRanks:
+    """
+    Read-only word -> frequency rank mapping stored in three binary files that are memory-mapped:
+    - [prefix].words.bin: the UTF-8 encoded words, sorted bytewise and concatenated
+    - [prefix].offsets.npy: int64 start offset of every word in words.bin, plus the end offset of the last word
+    - [prefix].ranks.npy: int64 rank of every word, aligned with the offsets
+    Loading is instant and the pages are shared by all processes that read the same files (e.g. preprocessing
+    workers) instead of every process holding its own dictionary. Lookups use binary search and behave like the
+    dictionary in frequency_ranks.json: `word in ranks`, `ranks[word]`, `ranks.get(word)` and `len(ranks)`.
+    """
+    def __init__(self, directory, prefix=RANK_STORE_PREFIX):
+        self.directory = directory
+        self.prefix = prefix
+        self._open()
+
+    def _open(self):
+        paths = get_rank_store_paths(self.directory, self.prefix)
+        with open(paths["words"], "rb") as f:
+            self._words = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = np.load(paths["offsets"], mmap_mode="r")
+        self._ranks = np.load(paths["ranks"], mmap_mode="r")
+        self._n_words = len(self._ranks)
+
+    def __getstate__(self):
+        # only pass the location to other processes, they map the same files
+        return {"directory": self.directory, "prefix": self.prefix}
+
+    def __setstate__(self, state):
+        self.directory = state["directory"]
+        self.prefix = state["prefix"]
+        self._open()
+
+    def _word_at(self, idx):
+        return self._words[int(self._offsets[idx]):int(self._offsets[idx + 1])]
+
+    def _find(self, word):
+        """ Return the position of word in the sorted word table or -1 """
+        encoded = word.encode("utf-8")
+        lo, hi = 0, self._n_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word_at(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_words and self._word_at(lo) == encoded:
+            return lo
+        return -1
+
+    def __len__(self):
+        return self._n_words
+
+    def __contains__(self, word):
+        return self._find(word) >= 0
+
+    def __getitem__(self, word):
+        idx = self._find(word)
+        if idx < 0:
+            raise KeyError(word)
+        return int(self._ranks[idx])
+
+    def get(self, word, default=None):
+        idx = self._find(word)
+        if idx < 0:
+            return default
+        return int(self._ranks[idx])
+
+
+def get_rank_store_paths(directory, prefix=RANK_STORE_PREFIX):
+    return {"words": directory / (prefix + ".words.bin"),
+            "offsets": directory / (prefix + ".offsets.npy"),
+            "ranks": directory / (prefix + ".ranks.npy")}
+
+
+def write_rank_store(ranks, directory, prefix=RANK_STORE_PREFIX):
+    """ Write a word -> rank dictionary into the binary files read by FrequencyRanks """
+    encoded_ranks = sorted((word.encode("utf-8"), rank) for word, rank in ranks.items())
+    offsets = np.zeros(len(encoded_ranks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(word) for word, _ in encoded_ranks])
+    rank_array = np.array([rank for _, rank in encoded_ranks], dtype=np.int64)
+
+    paths = get_rank_store_paths(directory, prefix)
+    with open(paths["words"], "wb") as fout:
+        for word, _ in encoded_ranks:
+            fout.write(word)
+    np.save(paths["offsets"], offsets)
+    np.save(paths["ranks"], rank_array)
+
+
 def write_ranks_into_file(lang):
     if lang.lower() not in {"en", "de"}:
         print("Language choice not supporting, defaulting to English")
@@ -39,19 +138,72 @@ def write_ranks_into_file(lang):
     ranks = read_in_embeddings_return_frequency_rank_dict(embedding_path)
     with open(get_data_auxiliary_dir(lang) / 'frequency_ranks.json', "w") as fout:
         json.dump(ranks, fout)
+    write_rank_store(ranks, get_data_auxiliary_dir(lang))
+
+
+def convert_json_ranks_to_store(lang):
+    """ Create the binary rank store from an existing frequency_ranks.json """
+    with open(get_data_auxiliary_dir(lang) / "frequency_ranks.json", "r", encoding="utf-8") as fin:
+        ranks = json.load(fin)
+    write_rank_store(ranks, get_data_auxiliary_dir(lang))
+
+
+def get_ranks_version(ranks):
+    """ Return a hash of the words and ranks of a FrequencyRanks (its files) or of a rank dictionary, it changes
+    whenever the ranks are rebuilt differently """
+    sha = hashlib.sha1()
+    if isinstance(ranks, FrequencyRanks):
+        for path in get_rank_store_paths(ranks.directory, ranks.prefix).values():
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+    else:
+        sha.update(json.dumps(ranks, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+def get_ranks_file_paths(lang):
+    """ The files load_ranks reads: the binary rank store if it exists, otherwise frequency_ranks.json """
+    rank_dir = get_data_auxiliary_dir(lang)
+    store_paths = list(get_rank_store_paths(rank_dir).values())
+    if all(os.path.exists(p) for p in store_paths):
+        return store_paths
+    return [rank_dir / "frequency_ranks.json"]
 
 
 def load_ranks(lang):
+    """ Return the memory-mapped FrequencyRanks if the binary rank store exists,
+    otherwise the dictionary from frequency_ranks.json.
+    The ranks are loaded once per process and language, every call returns the same object until the files change,
+    so the caches that are kept per ranks (see utils/feature_extraction.py) are reused """
     if lang.lower() not in {"en", "de"}:
         print("Language choice not supporting, defaulting to English")
 
-    ranking_file_path = get_data_auxiliary_dir(lang) / "frequency_ranks.json"
+    paths = get_ranks_file_paths(lang)
+    signature = [(str(p), os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in paths]
+    if lang in _loaded_ranks and _loaded_ranks[lang][0] == signature:
+        return _loaded_ranks[lang][1]
 
-    with open(ranking_file_path, "r", encoding="utf-8") as fin:
-        ranks = json.load(fin)
+    rank_dir = get_data_auxiliary_dir(lang)
+    if len(paths) > 1:
+        ranks = FrequencyRanks(rank_dir)
+    else:
+        print("No binary frequency rank store found in %s, loading frequency_ranks.json instead "
+              "(create the store with --from-json)" % str(rank_dir))
+        with open(paths[0], "r", encoding="utf-8") as fin:
+            ranks = json.load(fin)
+    _loaded_ranks[lang] = (signature, ranks)
     return ranks
 
 
-#write_ranks_into_file()
 if __name__=="__main__":
-    write_ranks_into_file("de")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", required=True, help="language of the fasttext embeddings, 'en' or 'de'")
+    parser.add_argument("--from-json", action="store_true", required=False,
+                        help="create the binary rank store from an existing frequency_ranks.json")
+    args = vars(parser.parse_args())
+
+    if args["from_json"]:
+        convert_json_ranks_to_store(args["lang"])
+    else:
+        write_ranks_into_file(args["lang"])
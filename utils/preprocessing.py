@@ -0,0 +1,107 @@
+"""
+Feature extraction and tokenization of chunks of sentence pairs for preprocess.py
+
+The same chunk function is used in the single-process mode and in the multi-process mode (--workers N). In the
+multi-process mode every worker loads its models once in the pool initializer, the chunks are returned in their
+original order so the output files have the same line order as the input files.
+With plain_source the features are extracted, but no control tokens are prepended to the source sentences; the
+feature values only go into the feature sidecar (for the fairseq task feature_control_translation).
+"""
+
+from collections import deque
+from multiprocessing import Pool
+from utils.helpers import load_tokenizer, prepend_features_to_strings
+from utils.feature_extraction import feature_bins_bundle_corpus
+from utils.feature_bin_preparation import get_feature_bins
+from utils.prepare_word_embeddings_frequency_ranks import load_ranks
+from utils.nlp_models import get_spacy_model, get_spacy_tokenizer
+from utils.feature_cache import FeatureCache
+
+# models and settings of the current (worker) process, filled by init_preprocessing
+_state = {}
+
+
+def init_preprocessing(lang, features_requested, tokenizer_type, batch_size, feature_cache_path=None,
+                       plain_source=False, tokenizer_threads=-1):
+    """ Load everything a process needs to preprocess chunks: the tokenizer, the spacy parser (only if the dependency
+    feature is requested), the bins, the frequency ranks (only if the frequency feature is requested) and the
+    connection to the feature cache.
+    tokenizer_threads: number of threads SentencePiece encodes a chunk with, -1: as many as cores """
+    _state["lang"] = lang
+    _state["features"] = features_requested
+    _state["plain_source"] = plain_source
+    _state["tokenizer_type"] = tokenizer_type
+    # the parser is only needed for the dependency feature, the frequency feature only needs the spacy tokenizer.
+    # The full spacy pipeline is loaded first, the spacy tokenizer is then shared with it instead of loaded again
+    if "dependency" in features_requested:
+        get_spacy_model(lang)
+    elif "frequency" in features_requested:
+        get_spacy_tokenizer(lang)
+    _state["tokenizer_model"] = load_tokenizer(tokenizer_type, lang)
+    _state["tokenizer_threads"] = tokenizer_threads
+    _state["batch_size"] = batch_size
+    _state["feature_bins"] = get_feature_bins()
+    _state["frequency_ranks"] = load_ranks(lang) if "frequency" in features_requested else None
+    _state["feature_cache"] = FeatureCache(feature_cache_path) if feature_cache_path else None
+
+
+def preprocess_chunk(chunk):
+    """
+    :param chunk: a tuple (list of source sentences, list of target sentences)
+    :return: a list with a tuple (new source string, new target string, exact feature values) for every sentence pair
+    """
+    src_batch, tgt_batch = chunk
+    feature_bundles = list(feature_bins_bundle_corpus(src_batch, tgt_batch, _state["lang"], _state["features"],
+                                                      _state["feature_bins"], _state["frequency_ranks"],
+                                                      batch_size=_state["batch_size"],
+                                                      feature_cache=_state["feature_cache"]))
+    f_vals_bins = [f_vals_bin for f_vals_bin, _ in feature_bundles]
+    prepended_features = [] if _state["plain_source"] else _state["features"]
+    # the whole chunk is tokenized at once, SentencePiece encodes the list of sentences in one call
+    new_sources, new_targets = prepend_features_to_strings(src_batch, tgt_batch, prepended_features, f_vals_bins,
+                                                           _state["tokenizer_type"], _state["tokenizer_model"],
+                                                           _state["tokenizer_threads"])
+    return [(sent_src_new, sent_tgt_new, f_vals_exact) for sent_src_new, sent_tgt_new, (_, f_vals_exact)
+            in zip(new_sources, new_targets, feature_bundles)]
+
+
+def preprocess_chunks(chunks, lang, features_requested, tokenizer_type, batch_size, workers=1, feature_cache_path=None,
+                      plain_source=False):
+    """
+    Yield the result of preprocess_chunk for every chunk, in the order of the chunks.
+    With workers > 1 the chunks are distributed over a pool of worker processes.
+    feature_cache_path: path to the SQLite feature cache or None to compute all features from scratch
+    plain_source: do not prepend the control tokens to the source sentences
+    """
+    # the worker processes already use all cores, every worker encodes with one thread
+    tokenizer_threads = 1 if workers > 1 else -1
+    init_args = (lang, features_requested, tokenizer_type, batch_size, feature_cache_path, plain_source,
+                 tokenizer_threads)
+    if workers > 1:
+        with Pool(processes=workers, initializer=init_preprocessing, initargs=init_args) as pool:
+            # keep at most two chunks per worker in flight so that the corpus is never read into memory at once,
+            # results are collected first in first out, i.e. in the original order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(preprocess_chunk, (chunk,)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+    else:
+        previous_cache = _state.get("feature_cache")
+        if _state.get("lang") != lang or _state.get("features") != features_requested or \
+                _state.get("tokenizer_type") != tokenizer_type:
+            init_preprocessing(*init_args)
+        _state["batch_size"] = batch_size
+        _state["plain_source"] = plain_source
+        _state["tokenizer_threads"] = tokenizer_threads
+        # keep the connection of the previous call to the same database, close it if another database is used
+        if previous_cache is not None and feature_cache_path and previous_cache.path == str(feature_cache_path):
+            _state["feature_cache"] = previous_cache
+        else:
+            if previous_cache is not None:
+                previous_cache.close()
+            _state["feature_cache"] = FeatureCache(feature_cache_path) if feature_cache_path else None
+        for chunk in chunks:
+            yield preprocess_chunk(chunk)
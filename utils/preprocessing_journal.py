@@ -0,0 +1,77 @@
+"""
+Progress journal of preprocess.py, for resuming an interrupted run with --resume
+
+The output of a split is written into temp files ([split].src.partial, [split].tgt.partial and the spool of the
+feature sidecar). After every chunk the temp files are flushed to disk and a line with the number of input lines done
+and the sizes of the temp files is appended to [split].journal. A resumed run truncates the temp files to the sizes of
+the last committed chunk and continues with the next input line, so the final files are byte-identical to the ones
+of an uninterrupted run. When a split is done, the temp files are renamed to the final files.
+"""
+
+import json
+import os
+from pathlib import Path
+
+
+def get_partial_path(path):
+    """ train.src -> train.src.partial """
+    path = Path(path)
+    return path.parent / (path.name + ".partial")
+
+
+def get_journal_path(src_path):
+    """ train.src -> train.journal in the same directory """
+    src_path = Path(src_path)
+    return src_path.parent / (src_path.stem + ".journal")
+
+
+def fsync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class PreprocessingJournal:
+    """
+    An append-only file of JSON lines: the settings of the run, one record per committed chunk
+    {"lines": ..., "sizes": {...}} and finally {"complete": true}. A last line that was not completely written
+    (the process died while writing it) is ignored.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self):
+        """ Return (settings, last committed record, complete) or (None, None, False) if there is no journal """
+        settings, last_record, complete = None, None, False
+        if not self.path.exists():
+            return settings, last_record, complete
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                record = json.loads(line)
+                if "settings" in record:
+                    settings = record["settings"]
+                elif record.get("complete"):
+                    complete = True
+                else:
+                    last_record = record
+        return settings, last_record, complete
+
+    def start(self, settings):
+        """ Start a new journal, dropping the progress of an earlier run """
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"settings": settings}) + "\n")
+            fsync_file(f)
+
+    def _append(self, record):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            fsync_file(f)
+
+    def commit(self, n_lines, sizes):
+        """ n_lines: number of input lines whose output is completely in the temp files,
+        sizes: dictionary name: size in bytes of every temp file after these lines """
+        self._append({"lines": n_lines, "sizes": sizes})
+
+    def complete(self):
+        self._append({"complete": True})
@@ -0,0 +1,278 @@
+"""
+Preprocessing of the shards of the corpus by any number of worker processes, on one or many hosts that share a
+directory
+
+The coordinator publishes a job: job.json in the job directory with the shards of the shard manifest
+(utils/shard_manifest.py) and the preprocess.py command. Every worker claims a shard by creating claims/[shard].lock
+with O_CREAT | O_EXCL, which succeeds for exactly one process, and runs preprocess.py --shard [shard] --resume. While
+the shard is preprocessed, the worker touches its lock file (heartbeat). A lock that has not been touched for
+stale_after seconds belongs to a dead worker: another worker renames it away (only one rename succeeds) and claims the
+shard; thanks to --resume the preprocessing continues from the last chunk in the shard's journal. A finished shard
+gets done/[shard].done. When all shards are done, the merge is claimed like a shard and runs exactly once.
+"""
+
+import json
+import os
+import socket
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from utils.paths import get_repo_dir
+
+MERGE_TASK = "merge"
+
+
+def write_json_atomically(path, content):
+    tmp_path = Path(str(path) + "." + uuid.uuid4().hex + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(content, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ShardJobDirectory:
+    """ The state of a job in a shared directory: job.json, claims/*.lock, done/*.done, failed/*.failed """
+    def __init__(self, job_dir, stale_after=600):
+        self.job_dir = Path(job_dir)
+        self.stale_after = stale_after
+        self.job_path = self.job_dir / "job.json"
+        self.claims_dir = self.job_dir / "claims"
+        self.done_dir = self.job_dir / "done"
+        self.failed_dir = self.job_dir / "failed"
+
+    def publish(self, job):
+        """ job: a dictionary with at least "shards" (names in processing order), "phases" (phase: shard names),
+        "lang", "features" and "command" (the preprocess.py arguments without --shard) """
+        for directory in [self.job_dir, self.claims_dir, self.done_dir, self.failed_dir]:
+            directory.mkdir(parents=True, exist_ok=True)
+        write_json_atomically(self.job_path, job)
+
+    def load_job(self):
+        with open(self.job_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def lock_path(self, task):
+        return self.claims_dir / (task + ".lock")
+
+    def done_path(self, task):
+        return self.done_dir / (task + ".done")
+
+    def failed_path(self, task):
+        return self.failed_dir / (task + ".failed")
+
+    def is_done(self, task):
+        return self.done_path(task).exists()
+
+    def is_failed(self, task):
+        return self.failed_path(task).exists()
+
+    def is_stale(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False
+
+    def try_claim(self, task, owner):
+        """ Create the lock of task for owner (a dictionary with a unique "token"), reclaim a stale lock.
+        Return True if owner holds the lock now """
+        lock_path = self.lock_path(task)
+        for _ in range(2):
+            try:
+                fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.is_stale(lock_path):
+                    return False
+                # only one of the workers that found the stale lock manages to rename it
+                stale_path = Path(str(lock_path) + ".stale." + owner["token"])
+                try:
+                    os.rename(lock_path, stale_path)
+                except FileNotFoundError:
+                    return False
+                if not self.is_stale(stale_path):
+                    # the owner touched the lock in the meantime, put it back if nobody claimed the task yet
+                    try:
+                        os.link(stale_path, lock_path)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_path)
+                    return False
+                os.remove(stale_path)
+                print("... Reclaimed the stale claim of %s" % task)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(owner, f)
+            return True
+        return False
+
+    def holds_claim(self, task, owner):
+        try:
+            with open(self.lock_path(task), "r", encoding="utf-8") as f:
+                return json.load(f).get("token") == owner["token"]
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def heartbeat(self, task, owner):
+        """ Touch the lock of task, return False if owner lost the claim (it was reclaimed as stale) """
+        if not self.holds_claim(task, owner):
+            return False
+        os.utime(str(self.lock_path(task)), None)
+        return True
+
+    def release(self, task, owner):
+        if self.holds_claim(task, owner):
+            os.remove(self.lock_path(task))
+
+    def mark_done(self, task, owner, info=None):
+        write_json_atomically(self.done_path(task), dict(owner, **(info or {})))
+        self.release(task, owner)
+
+    def mark_failed(self, task, owner, info=None):
+        write_json_atomically(self.failed_path(task), dict(owner, **(info or {})))
+        self.release(task, owner)
+
+    def status(self):
+        """ Return a dictionary state: list of shards, the states are done, failed, claimed and pending """
+        job = self.load_job()
+        states = {"done": [], "failed": [], "claimed": [], "pending": []}
+        for shard in job["shards"]:
+            if self.is_done(shard):
+                states["done"].append(shard)
+            elif self.is_failed(shard):
+                states["failed"].append(shard)
+            elif self.lock_path(shard).exists():
+                states["claimed"].append(shard)
+            else:
+                states["pending"].append(shard)
+        return states
+
+
+def new_owner(worker_id=None):
+    token = uuid.uuid4().hex
+    return {"token": token, "worker": worker_id or "%s-%d" % (socket.gethostname(), os.getpid()),
+            "host": socket.gethostname(), "pid": os.getpid(), "claimed_at": time.time()}
+
+
+def die_with_parent():
+    """ Linux: the child gets SIGTERM when the worker dies, so that a reclaimed shard is never preprocessed by two
+    processes at the same time """
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6", use_errno=True).prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+
+
+def run_claimed_task(jobs, task, owner, command, heartbeat_interval):
+    """ Run command while touching the lock of task every heartbeat_interval seconds.
+    Return the exit code, or None if the claim was lost and the command was stopped """
+    preexec_fn = die_with_parent if sys.platform.startswith("linux") else None
+    process = subprocess.Popen(command, cwd=str(get_repo_dir()), preexec_fn=preexec_fn)
+    while True:
+        try:
+            return process.wait(timeout=heartbeat_interval)
+        except subprocess.TimeoutExpired:
+            if not jobs.heartbeat(task, owner):
+                print("... Lost the claim of %s, stopping" % task)
+                process.terminate()
+                process.wait()
+                return None
+
+
+def merge_job(job):
+    """ Merge the preprocessed shards of every phase of the job """
+    from additional_scripts.shard_processing_merge import merge_preprocessed_shards
+    for phase, shard_names in job["phases"].items():
+        merge_preprocessed_shards(phase, job["lang"], [name[len(phase) + 1:] for name in shard_names],
+                                  job["features"])
+
+
+def run_claimed_merge(jobs, job, owner, heartbeat_interval):
+    """ Merge the shards in a thread while touching the lock of the merge, return True if the merge succeeded """
+    errors = []
+
+    def merge():
+        try:
+            merge_job(job)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=merge)
+    thread.start()
+    while thread.is_alive():
+        thread.join(heartbeat_interval)
+        jobs.heartbeat(MERGE_TASK, owner)
+    if errors:
+        print("... The merge failed: %s" % str(errors[0]))
+        jobs.mark_failed(MERGE_TASK, owner, {"error": str(errors[0])})
+        return False
+    jobs.mark_done(MERGE_TASK, owner)
+    return True
+
+
+def get_local_feature_cache_path(lang):
+    """ The feature cache on the local disk of this host, shared by the workers of this host only """
+    cache_dir = Path(tempfile.gettempdir()) / "rewrite_text_feature_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / (lang + ".sqlite")
+
+
+def get_shard_command(job, shard):
+    """ The preprocess.py command of a shard. SQLite's WAL mode does not work on network file systems, so unless the
+    job sets --feature-cache or --no-feature-cache itself, every host uses its own cache on its local disk instead of
+    the default cache in the shared data_preprocessed directory """
+    command = [sys.executable] + job["command"] + ["--shard", shard, "--resume"]
+    if not any(arg.split("=")[0] in {"--feature-cache", "--no-feature-cache"} for arg in job["command"]):
+        command += ["--feature-cache", str(get_local_feature_cache_path(job["lang"]))]
+    return command
+
+
+def run_worker(job_dir, worker_id=None, heartbeat_interval=30, stale_after=600, merge=True):
+    """ Claim and preprocess shards until all are done, then merge the shards if no other worker does it.
+    Return True if the job is complete (all shards done and merged) """
+    jobs = ShardJobDirectory(job_dir, stale_after=stale_after)
+    job = jobs.load_job()
+    while True:
+        owner = new_owner(worker_id)
+        claimed = None
+        for shard in job["shards"]:
+            if not jobs.is_done(shard) and not jobs.is_failed(shard) and jobs.try_claim(shard, owner):
+                claimed = shard
+                break
+
+        if claimed is not None:
+            # a reclaimed shard may have been finished by its previous owner right before it died
+            if jobs.is_done(claimed):
+                jobs.release(claimed, owner)
+                continue
+            print("... Worker %s preprocesses shard %s" % (owner["worker"], claimed))
+            command = get_shard_command(job, claimed)
+            returncode = run_claimed_task(jobs, claimed, owner, command, heartbeat_interval)
+            if returncode == 0:
+                jobs.mark_done(claimed, owner)
+            elif returncode is not None:
+                print("... Shard %s failed with exit code %d" % (claimed, returncode))
+                jobs.mark_failed(claimed, owner, {"returncode": returncode})
+            continue
+
+        states = jobs.status()
+        if states["failed"]:
+            print("... Shards failed: %s, not merging" % ", ".join(states["failed"]))
+            return False
+        if states["claimed"]:
+            # other workers are busy, wait in case one of them dies and its shard has to be reclaimed
+            time.sleep(heartbeat_interval)
+            continue
+        if states["pending"]:
+            continue
+        if not merge or jobs.is_done(MERGE_TASK) or jobs.is_failed(MERGE_TASK):
+            return jobs.is_done(MERGE_TASK)
+        if jobs.try_claim(MERGE_TASK, owner):
+            print("... Worker %s merges the shards" % owner["worker"])
+            return run_claimed_merge(jobs, job, owner, heartbeat_interval)
+        time.sleep(heartbeat_interval)
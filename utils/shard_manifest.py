@@ -0,0 +1,172 @@
+"""
+Shards of the corpus as byte ranges of the original files
+
+A shard is not a copy of the corpus: the manifest data_shards/[lang]/manifest.json holds for every shard the byte
+range of its lines in data/[lang]/[phase].src and data/[lang]/[phase].tgt (the ranges of both files cover the same
+lines) and the number of lines. preprocess.py --shard [name] seeks to the start of the ranges and reads the lines
+directly. The preprocessed shards are merged with kernel copies (os.copy_file_range or os.sendfile) instead of
+being copied line by line.
+"""
+
+import json
+import os
+import shutil
+from itertools import islice
+import numpy as np
+from utils.paths import get_data_shard_dir, get_data_original_dir, suffixes
+
+BLOCK_SIZE = 1 << 24
+
+
+def get_shard_manifest_path(lang):
+    return get_data_shard_dir(lang) / "manifest.json"
+
+
+def load_shard_manifest(lang):
+    """ Return the dictionary shard name: shard of the manifest, empty if there is no manifest """
+    manifest_path = get_shard_manifest_path(lang)
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_shard_manifest(lang, manifest):
+    manifest_path = get_shard_manifest_path(lang)
+    tmp_path = manifest_path.parent / (manifest_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_shard(lang, shard_name):
+    """ Return the shard from the manifest or None if the manifest has no shard of this name """
+    return load_shard_manifest(lang).get(shard_name)
+
+
+def get_phase_shard_names(manifest, phase):
+    """ Return the names of the shards of phase in the order of the corpus """
+    return sorted((name for name, shard in manifest.items() if shard["phase"] == phase),
+                  key=lambda name: manifest[name]["first_line"])
+
+
+def line_start_offsets(path, every, skip=0):
+    """
+    Read the file once and return (byte offsets of the lines skip, skip + every, skip + 2 * every, ..., number of
+    lines in the file). Only offsets of lines that exist are returned.
+    """
+    offsets, line_indices = [], []
+    next_line = skip
+    n_newlines, size, last_byte = 0, 0, b""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            positions = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            # line t starts right after the newline number t - 1
+            while next_line == 0 or next_line - 1 < n_newlines + len(positions):
+                offsets.append(0 if next_line == 0 else size + int(positions[next_line - 1 - n_newlines]) + 1)
+                line_indices.append(next_line)
+                next_line += every
+            n_newlines += len(positions)
+            size += len(block)
+            last_byte = block[-1:]
+
+    n_lines = n_newlines + (1 if size > 0 and last_byte != b"\n" else 0)
+    offsets = [offset for offset, line in zip(offsets, line_indices) if line < n_lines]
+    return offsets, n_lines
+
+
+def create_shard_manifest(lang, l_per_s, phase="train", skip=0):
+    """
+    Add the shards of phase to the manifest, each with l_per_s lines (the last one may have less): phase_0,
+    phase_1, ... or phase_1, phase_2, ... if the first skip lines are skipped. Existing shards of phase are replaced.
+    Only the original files are read, nothing is written apart from the manifest.
+    """
+    paths = {suffix: get_data_original_dir(lang) / (phase + "." + suffix) for suffix in suffixes}
+    offsets, n_lines = {}, {}
+    for suffix, path in paths.items():
+        offsets[suffix], n_lines[suffix] = line_start_offsets(path, l_per_s, skip)
+    if n_lines["src"] != n_lines["tgt"]:
+        raise ValueError("%s has %d lines, %s has %d lines" % (str(paths["src"]), n_lines["src"],
+                                                               str(paths["tgt"]), n_lines["tgt"]))
+
+    manifest = {name: shard for name, shard in load_shard_manifest(lang).items() if shard["phase"] != phase}
+    first_id = 1 if skip else 0
+    for k in range(len(offsets["src"])):
+        first_line = skip + k * l_per_s
+        shard = {"phase": phase, "first_line": first_line, "lines": min(l_per_s, n_lines["src"] - first_line)}
+        for suffix, path in paths.items():
+            end = offsets[suffix][k + 1] if k + 1 < len(offsets[suffix]) else os.path.getsize(path)
+            shard[suffix] = {"path": str(path), "start": offsets[suffix][k], "end": end}
+        manifest[phase + "_" + str(first_id + k)] = shard
+    save_shard_manifest(lang, manifest)
+    return manifest
+
+
+def describe_shard(shard):
+    """ A list of strings path:start-end, identifies the input of a shard e.g. in the preprocessing journal """
+    return ["%s:%d-%d" % (shard[suffix]["path"], shard[suffix]["start"], shard[suffix]["end"]) for suffix in suffixes]
+
+
+def yield_shard_batches(shard, batch_size, skip=0):
+    """ Like yield_batches_in_parallel for the byte ranges of a shard: yield [src lines, tgt lines] for every
+    batch_size stripped lines, after skipping the first skip lines of the shard """
+    files = [open(shard[suffix]["path"], "rb") for suffix in suffixes]
+    try:
+        for f, suffix in zip(files, suffixes):
+            f.seek(shard[suffix]["start"])
+        lines = zip(*[islice(f, shard["lines"]) for f in files])
+        batch = []
+        for parallel_lines in islice(lines, skip, None):
+            batch.append([line.decode("utf-8").strip() for line in parallel_lines])
+            if len(batch) == batch_size:
+                yield [list(lines) for lines in zip(*batch)]
+                batch = []
+        if batch:
+            yield [list(lines) for lines in zip(*batch)]
+    finally:
+        [f.close() for f in files]
+
+
+def count_lines(path):
+    """ Number of lines in the file, a last line without a line break counts as well """
+    n_lines, last_byte = 0, b""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            n_lines += block.count(b"\n")
+            last_byte = block[-1:]
+    return n_lines + (1 if last_byte not in {b"", b"\n"} else 0)
+
+
+def append_file(dst, src_path):
+    """ Append the content of the file src_path to the open unbuffered binary file dst. The bytes are copied by
+    the kernel with os.copy_file_range or os.sendfile if possible, else with shutil.copyfileobj """
+    with open(src_path, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, offset_src=copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        if copied < size and hasattr(os, "sendfile"):
+            try:
+                while copied < size:
+                    n = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        if copied < size:
+            src.seek(copied)
+            shutil.copyfileobj(src, dst)
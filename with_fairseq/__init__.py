@@ -0,0 +1,2 @@
+# importing the package registers the custom fairseq tasks, this is also what --user-dir with_fairseq does
+from . import feature_control_task
@@ -1,12 +1,22 @@
 import shutil
 import os
+import json
+import logging
 from pathlib import Path
 import contextlib
 import subprocess
+import uuid
+import torch
 from fairseq import options
-from fairseq_cli import preprocess, train, generate
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.distributed import utils as distributed_utils
+from fairseq.logging import progress_bar
+from fairseq_cli import preprocess, train
 from utils.paths import get_data_preprocessed_dir, get_evaluation_dir
-from utils.helpers import log_stdout, yield_lines, parse_model_hypotheses
+from utils.helpers import yield_lines
+from with_fairseq.feature_control_task import FEATURE_CONTROL_TASK, control_symbols, get_feature_table_path, \
+    control_token_prefixes
+from generation.rewriter import Rewriter
 
 import torch.distributed as dist
 
@@ -18,7 +28,11 @@ def preprocess_with_fairseq(data_directory,
                             dataset_implementation="raw",
                             trainpref="train",
                             validpref="valid",
-                            testpref="test"):
+                            testpref="test",
+                            feature_control=False):
+    """ feature_control: data_directory holds sources without control tokens and the feature tables
+    [split].features.npz, copy the tables into destination_directory and add all control tokens to the source
+    dictionary, for the task feature_control_translation """
 
     full_train_prefix = data_directory / trainpref
     full_valid_prefix = data_directory / validpref
@@ -36,6 +50,9 @@ def preprocess_with_fairseq(data_directory,
     print("*** Starting preprocessing")
     preprocess.main(preprocess_args)
 
+    if feature_control:
+        prepare_feature_control(data_directory, destination_directory, source_lang, [trainpref, validpref, testpref])
+
     """
     This will create dict* files and binary files in the destdir
     Note that overwriting doesn't happen: an error will be raised (FileExistsError) if the command is re-run.
@@ -43,6 +60,69 @@ def preprocess_with_fairseq(data_directory,
     """
 
 
+def prepare_feature_control(data_directory, destination_directory, source_lang="src",
+                            prefixes=("train", "valid", "test")):
+    """ Copy the feature tables into destination_directory and add all control tokens to the source dictionary,
+    for the task feature_control_translation """
+    for prefix in prefixes:
+        shutil.copy(get_feature_table_path(data_directory, prefix),
+                    get_feature_table_path(destination_directory, prefix))
+    add_control_symbols_to_dictionary(destination_directory / ("dict." + source_lang + ".txt"), control_symbols())
+
+
+def add_control_symbols_to_dictionary(dict_path, symbols):
+    """ Append the symbols that are not in the fairseq dictionary file yet, the existing ids stay the same """
+    with open(dict_path, "r", encoding="utf-8") as f:
+        existing = {line.split(" ")[0] for line in f}
+    with open(dict_path, "a", encoding="utf-8") as f:
+        for symbol in symbols:
+            if symbol not in existing:
+                f.write(symbol + " 1\n")
+
+
+def get_rendezvous_path(experiment_dir):
+    """ The file through which the training processes find each other, unique for every run so that concurrent
+    experiments never share it """
+    return Path(experiment_dir) / ("distributed_init." + uuid.uuid4().hex)
+
+
+class EpochThroughputHandler(logging.Handler):
+    """ Appends the end-of-epoch training summaries of fairseq's JSON progress bar (logged under the name "train")
+    to the file throughput_log, one JSON line per epoch """
+    def __init__(self, throughput_log):
+        super().__init__()
+        self.throughput_log = throughput_log
+
+    def emit(self, record):
+        if record.name != "train":
+            return
+        with open(self.throughput_log, "a", encoding="utf-8") as f:
+            f.write(record.getMessage() + "\n")
+
+
+@contextlib.contextmanager
+def collect_epoch_throughput(throughput_log):
+    """ Collect the training summaries while training runs in this process """
+    handler = EpochThroughputHandler(throughput_log)
+    progress_logger = logging.getLogger(progress_bar.__name__)
+    progress_logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        progress_logger.removeHandler(handler)
+
+
+def distributed_train_worker(i, cfg, threads, throughput_log):
+    """ Entry point of training process i of torch.multiprocessing.spawn, the cores are divided among the processes.
+    The summaries are averaged over all processes, the first one writes them """
+    torch.set_num_threads(threads)
+    if i > 0:
+        distributed_utils.distributed_main(i, train.main, cfg, {})
+        return
+    with collect_epoch_throughput(throughput_log):
+        distributed_utils.distributed_main(i, train.main, cfg, {})
+
+
 def train_with_fairseq(dir_with_preprocessed_files, experiment_dir,
                        batch_size=16,
                        lr=0.002,
@@ -54,35 +134,117 @@ def train_with_fairseq(dir_with_preprocessed_files, experiment_dir,
                        dir_checkpoints_suffix="checkpoints",
                        source_lang="src",
                        target_lang="tgt",
-                       dataset_implementation="raw"):
+                       dataset_implementation="raw",
+                       task="translation",
+                       features_requested=None,
+                       distributed_world_size=1,
+                       max_tokens=None,
+                       num_batch_buckets=0,
+                       num_workers=1,
+                       data_buffer_size=10):
     """ Prepare the arguments as a list, pass them to the parser and pass the parser
      to the  train.main(train_args)
 
      dir_with_preprocessed_files: pointing to the dir with train/val/test.src-tgt.src/tgt and vocab*
      experiment_dir: str or Path, repository_path+experiments+experiment_ID
+     task: "translation" or "feature_control_translation", the latter prepends the control tokens of the
+     features_requested (a list) while building the batches
+     distributed_world_size: number of data-parallel training processes on the CPU, they synchronize the gradients
+     with gloo; every process trains on batches of batch_size
+     batch_size, max_tokens: the maximum number of sentences and of tokens in a batch, either can be None
+     num_batch_buckets: > 0 to put sentences of similar length into the same batch, less padding, needs max_tokens
+     num_workers, data_buffer_size: processes that load the batches and the number of batches they prefetch
+     The end-of-epoch training summaries of this run are written as JSON lines into experiment_dir/throughput.jsonl
+     and the throughput of every epoch into experiment_dir/throughput.json
     """
     # NOTE: the first arg is "data" (no flag?) and it's a dir that has to contain the preprocessed files (dict)
     # as well as ?
     # every
-    dist.init_process_group('gloo', init_method='file:///tmp/somefile', rank=0, world_size=1)
+    rendezvous_path = get_rendezvous_path(experiment_dir)
     save_dir_full_path = experiment_dir / dir_checkpoints_suffix
     # /home/skrjanec/rewrite_text/experiments/03/checkpoints
     if not os.path.exists(save_dir_full_path):
         os.makedirs(save_dir_full_path)
 
+    # a new file for every run, the throughput of earlier runs with other settings is not mixed in
+    throughput_log = Path(experiment_dir) / "throughput.jsonl"
+    open(throughput_log, "w").close()
     mini_args = [dir_with_preprocessed_files, "--arch", arch, "--max-epoch", max_epoch, "--source-lang",
                  source_lang, "--target-lang", target_lang, "--save-dir", save_dir_full_path,
-                 "--batch-size", batch_size, "--update-freq", updates, "--dataset-impl", dataset_implementation,
-                 "--task", "translation", "--optimizer", optimizer, "--lr", lr, "--patience", patience,
-                 "--criterion", "label_smoothed_cross_entropy", "--label-smoothing", 0.54, "--no-epoch-checkpoints"]
-
-
+                 "--update-freq", updates, "--dataset-impl", dataset_implementation,
+                 "--task", task, "--optimizer", optimizer, "--lr", lr, "--patience", patience,
+                 "--criterion", "label_smoothed_cross_entropy", "--label-smoothing", 0.54, "--no-epoch-checkpoints",
+                 "--num-batch-buckets", num_batch_buckets, "--num-workers", num_workers,
+                 "--data-buffer-size", data_buffer_size, "--log-format", "json"]
+    if batch_size:
+        mini_args += ["--batch-size", batch_size]
+    if max_tokens:
+        mini_args += ["--max-tokens", max_tokens]
+    if task == FEATURE_CONTROL_TASK:
+        mini_args += ["--features-requested", ",".join(features_requested)]
+    if distributed_world_size > 1:
+        # the default backend pytorch_ddp passes device_ids to DistributedDataParallel, which fails for a CPU model
+        mini_args += ["--cpu", "--distributed-world-size", distributed_world_size, "--distributed-backend", "gloo",
+                      "--distributed-init-method", rendezvous_path.as_uri(), "--ddp-backend", "legacy_ddp"]
 
     mini_args = [str(a) for a in mini_args]
     train_parser = options.get_training_parser()
     mini_train_args = options.parse_args_and_arch(train_parser, mini_args)
     print("*** Starting training")
-    train.main(mini_train_args)
+    try:
+        if distributed_world_size > 1:
+            # fairseq's own launcher only spawns one process per GPU, the CPU processes are spawned here
+            cfg = convert_namespace_to_omegaconf(mini_train_args)
+            cfg.distributed_training.distributed_rank = None  # the rank of every process is its index
+            threads = max(1, (os.cpu_count() or 1) // distributed_world_size)
+            torch.multiprocessing.spawn(fn=distributed_train_worker, args=(cfg, threads, throughput_log),
+                                        nprocs=distributed_world_size, join=True)
+        else:
+            dist.init_process_group('gloo', init_method=rendezvous_path.as_uri(), rank=0, world_size=1)
+            with collect_epoch_throughput(throughput_log):
+                train.main(mini_train_args)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
+        if rendezvous_path.exists():
+            rendezvous_path.unlink()
+
+    settings = {"batch_size": batch_size, "max_tokens": max_tokens, "update_freq": updates,
+                "num_batch_buckets": num_batch_buckets, "num_workers": num_workers,
+                "data_buffer_size": data_buffer_size, "distributed_world_size": distributed_world_size}
+    write_throughput_report(throughput_log, Path(experiment_dir) / "throughput.json", settings)
+
+
+def read_training_throughput(throughput_log):
+    """ Return a dictionary epoch: {"wps": ..., "wpb": ..., "bsz": ...} from the training summaries collected by
+    EpochThroughputHandler, wps: target tokens per second, wpb: target tokens per batch, bsz: sentences per batch """
+    epochs = {}
+    if not os.path.exists(throughput_log):
+        return epochs
+    with open(throughput_log, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "train_wps" in record:
+                epochs[int(record["epoch"])] = {key: float(record["train_" + key]) for key in ["wps", "wpb", "bsz"]
+                                                if "train_" + key in record}
+    return epochs
+
+
+def write_throughput_report(throughput_log, report_path, settings):
+    """ Write the batching settings and the training throughput of every epoch into report_path, to compare the
+    throughput of different settings """
+    epochs = read_training_throughput(throughput_log)
+    wps = [values["wps"] for values in epochs.values() if "wps" in values]
+    report = {"settings": settings, "mean_wps": sum(wps) / len(wps) if wps else None,
+              "epochs": {str(epoch): values for epoch, values in sorted(epochs.items())}}
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    if wps:
+        print("... Training throughput: %.1f target tokens/s on average over %d epochs, see %s"
+              % (report["mean_wps"], len(wps), str(report_path)))
 
 
 def generate_with_fairseq(dir_with_model_test_data_and_vocab,
@@ -91,10 +253,20 @@ def generate_with_fairseq(dir_with_model_test_data_and_vocab,
                           beam_size=8,
                           model_name="checkpoint_best.pt",
                           dataset_implementation="raw",
-                          source_vocab_fname="dict.src.txt",
-                          target_vocab_fname="dict.tgt.txt",
                           source_test_fname="test.src-tgt.src",
-                          target_test_fname="test.src-tgt.tgt"):
+                          target_test_fname="test.src-tgt.tgt",
+                          task="translation",
+                          features_requested=None,
+                          text_test_dir=None):
+    """ Rewrite the test sources with the model in this process (generation/rewriter.py) and write the best
+    hypothesis of every sentence into dir_with_model_test_data_and_vocab/generation2.out
+
+    The dictionaries dict.src.txt and dict.tgt.txt and the text of the test split are copied next to the model, the
+    evaluation reads the test text there. Generation never reads the binarized test split: the tokenized text is
+    encoded with the dictionaries. dataset_implementation only selects where the text comes from: "raw" copies the
+    text files of dir_with_test_data_and_vocab, otherwise the preprocessed test.src and test.tgt of text_test_dir
+    (default: the parent of dir_with_test_data_and_vocab) are copied
+    """
     # the first argument is a directory that contains the model, the vocabulary dict* and test files
     # copy the dict* and test* files from respective directories
     #print("dir with model, move the test data and vocabs here", dir_with_model_test_data_and_vocab)
@@ -105,51 +277,43 @@ def generate_with_fairseq(dir_with_model_test_data_and_vocab,
         dir_with_test_data_and_vocab = Path(dir_with_test_data_and_vocab)
     #print("dir with model, move the test data and vocabs here", dir_with_model_test_data_and_vocab)
     #print("dir with all data and vocabs, move from here", dir_with_test_data_and_vocab)
-    # copy vocab into the dir_with_model_test_data_and_vocab
-    source_vocab_full = dir_with_test_data_and_vocab / source_vocab_fname  # origin
-    target_vocab_full = dir_with_test_data_and_vocab / target_vocab_fname  # origin
-    dest_src_vocab = dir_with_model_test_data_and_vocab / source_vocab_fname  # destination
-    dest_tgt_vocab = dir_with_model_test_data_and_vocab / target_vocab_fname  # destination
-    #print("origin and destination, SOURCE VOCAB", source_vocab_full, dest_src_vocab)
-    #print("origin and destination, *TARGET* VOCAB", target_vocab_full, dest_tgt_vocab)
-    shutil.copy(source_vocab_full, dest_src_vocab)
-    shutil.copy(target_vocab_full, dest_tgt_vocab)
+    # copy vocab into the dir_with_model_test_data_and_vocab, the task of the model loads dict.src.txt and dict.tgt.txt
+    for vocab_fname in ["dict.src.txt", "dict.tgt.txt"]:
+        shutil.copy(dir_with_test_data_and_vocab / vocab_fname, dir_with_model_test_data_and_vocab / vocab_fname)
 
     # copy test data into the dir_with_model_test_data_and_vocab
     source_test_full = dir_with_test_data_and_vocab / source_test_fname  # origin
     target_test_full = dir_with_test_data_and_vocab / target_test_fname  # origin
     dest_src_test = dir_with_model_test_data_and_vocab / source_test_fname  # destination
     dest_tgt_test = dir_with_model_test_data_and_vocab / target_test_fname  # destination
-    shutil.copy(source_test_full, dest_src_test)
-    shutil.copy(target_test_full, dest_tgt_test)
+    if dataset_implementation == "raw":
+        shutil.copy(source_test_full, dest_src_test)
+        shutil.copy(target_test_full, dest_tgt_test)
+    else:
+        # the binarized datasets hold token ids, the text of the test split is next to the fairseq directory
+        # (the preprocessed test.src and test.tgt)
+        if text_test_dir is None:
+            text_test_dir = dir_with_test_data_and_vocab.parent
+        for test_full, dest_test in [(source_test_full, dest_src_test), (target_test_full, dest_tgt_test)]:
+            shutil.copy(Path(text_test_dir) / ("test." + test_full.name.split(".")[-1]), dest_test)
 
+    # the model decodes the tokenized test sources in this process, the hypotheses come back in the order of the lines
     model_path = dir_with_model_test_data_and_vocab / model_name
-    generation_args = [dir_with_model_test_data_and_vocab, "--path", model_path,
-                       "--batch-size", batch_size, "--beam", beam_size,
-                       "--dataset-impl", dataset_implementation]
-
-    # # path: path to the model
-    # generation_arg = ["/home/AK/skrjanec/toydata/experiments/01/checkpoints", "--path",
-    #                   "/home/AK/skrjanec/toydata/experiments/01/checkpoints/checkpoint_best.pt",
-    #                   "--batch-size", "16", "--beam", "8", "--dataset-impl", dataset_implementation]
-
-    generation_arg = [str(a) for a in generation_args]
-    generate_parser = options.get_generation_parser()
-    gen_args = options.parse_args_and_arch(generate_parser, generation_arg)
-
-    out_file = str(dir_with_model_test_data_and_vocab / "generation.out")
+    rewriter = Rewriter(model_path, dir_with_model_test_data_and_vocab, beam=beam_size, batch_size=batch_size)
+    source_lines = list(yield_lines(dest_src_test))
+    if task == FEATURE_CONTROL_TASK:
+        # the sources have no control tokens, they are taken from the feature table of the test split
+        prefixes = control_token_prefixes(get_feature_table_path(dir_with_test_data_and_vocab, "test"),
+                                          features_requested)
+        source_lines = [prefix + line for prefix, line in zip(prefixes, source_lines)]
     print("*** Starting generation - inference")
-    with log_stdout(out_file, mute_stdout=True):
-        generate.main(gen_args)
-        
+    hypotheses = rewriter.rewrite_tokenized(source_lines)
 
-    # parse this file to fetch out the hypotheses H-N, order them 0, 1, 2... and evaluate with sacrebleu
-    ordered_hypotheses = parse_model_hypotheses(out_file)
-    # overwrite the file with unordered hypotheses
+    # the best hypothesis of every test sentence, in order, for the evaluation
     out_file2 = str(dir_with_model_test_data_and_vocab / "generation2.out")
     with open(out_file2, "w") as fout:
-        for line in ordered_hypotheses:
-            fout.write(line[0] + "\n")
+        for sentence_hypotheses in hypotheses:
+            fout.write(sentence_hypotheses[0]["tokens"] + "\n")
 
 
 def evaluation_automatic_metrics(dir_with_model_test_data_and_vocab,
@@ -0,0 +1,148 @@
+"""
+fairseq task that prepends the feature control tokens to the source sentences while the batches are built
+
+The corpus is preprocessed once without control tokens (preprocess.py --plain-source) and binarized once. The feature
+sidecar [split].features.npz (see utils/feature_sidecar.py) next to the binarized files holds the bins of all
+extracted features for every line. The task looks up the control tokens of the requested features, e.g.
+--features-requested frequency,length, and prepends them to every source sentence, so every feature combination
+trains on the same data directory.
+
+The task is registered when this module is imported (fairseq_base.py does that), or with --user-dir with_fairseq.
+"""
+
+import os
+from dataclasses import dataclass, field
+import numpy as np
+import torch
+from fairseq import utils
+from fairseq.data import BaseWrapperDataset, LanguagePairDataset
+from fairseq.tasks import register_task
+from fairseq.tasks.translation import TranslationConfig, TranslationTask, load_langpair_dataset
+from utils.helpers import get_control_token
+from utils.feature_bin_preparation import get_feature_bins
+from utils.feature_sidecar import load_sidecar
+
+FEATURE_CONTROL_TASK = "feature_control_translation"
+CONTROL_FEATURES = ["dependency", "frequency", "length", "levenshtein"]
+
+
+def control_symbols():
+    """ Return the control tokens of all bins of all features, in a fixed order """
+    feature_bins = get_feature_bins()
+    symbols = []
+    for f in CONTROL_FEATURES:
+        for value in feature_bins[f]:
+            symbol = get_control_token(f, value)
+            if symbol not in symbols:
+                symbols.append(symbol)
+    return symbols
+
+
+def get_feature_table_path(data_path, split):
+    return os.path.join(str(data_path), split + ".features.npz")
+
+
+def control_token_prefixes(table_path, features_requested):
+    """ Return the control tokens of the requested features of every line of a feature table as a string, e.g.
+    "<Length_0.75> <Leven_0.8> ", the tokens the task prepends to the line """
+    sidecar = load_sidecar(table_path)
+    feature_bins = get_feature_bins()
+    columns = []
+    for f in features_requested:
+        symbols = np.array([get_control_token(f, value) for value in feature_bins[f]])
+        columns.append(symbols[sidecar["bins"][:, sidecar["features"].index(f)]])
+    return ["".join(token + " " for token in line_tokens) for line_tokens in zip(*columns)] if columns \
+        else [""] * len(sidecar["bins"])
+
+
+class ControlTokenDataset(BaseWrapperDataset):
+    """ Wraps the dataset of the source sentences, item i is the control token ids of line i followed by the
+    tokens of the sentence """
+    def __init__(self, dataset, control_tokens):
+        super().__init__(dataset)
+        assert len(dataset) == len(control_tokens), \
+            "the feature table has %d lines, the source dataset %d" % (len(control_tokens), len(dataset))
+        self.control_tokens = torch.from_numpy(control_tokens)
+        self._sizes = np.asarray(dataset.sizes) + control_tokens.shape[1]
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    def num_tokens(self, index):
+        return self._sizes[index]
+
+    def size(self, index):
+        return self._sizes[index]
+
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        return torch.cat([self.control_tokens[index].type_as(item), item])
+
+
+@dataclass
+class FeatureControlTranslationConfig(TranslationConfig):
+    features_requested: str = field(
+        default="", metadata={"help": "comma separated features whose control tokens are prepended to the source "
+                                      "sentences, e.g. frequency,length"})
+
+
+@register_task(FEATURE_CONTROL_TASK, dataclass=FeatureControlTranslationConfig)
+class FeatureControlTranslationTask(TranslationTask):
+    """ Translation task that reads the control tokens of the source sentences from the feature table of each split """
+    def __init__(self, cfg, src_dict, tgt_dict):
+        super().__init__(cfg, src_dict, tgt_dict)
+        self.features_requested = [f for f in cfg.features_requested.split(",") if f]
+        unknown = set(self.features_requested) - set(CONTROL_FEATURES)
+        if unknown:
+            raise ValueError("Unknown features requested: %s, options: %s" % (", ".join(sorted(unknown)),
+                                                                             ", ".join(CONTROL_FEATURES)))
+
+    @classmethod
+    def setup_task(cls, cfg, **kwargs):
+        task = super().setup_task(cfg, **kwargs)
+        # fairseq_base.preprocess_with_fairseq writes the symbols into dict.src.txt, this only covers dictionaries
+        # created elsewhere; the order is fixed so training and generation build the same dictionary
+        for symbol in control_symbols():
+            if symbol not in task.src_dict:
+                task.src_dict.add_symbol(symbol)
+        return task
+
+    def control_token_table(self, data_path, split):
+        """ Return an int64 array (n_lines, n_requested_features) with the dictionary ids of the control tokens """
+        sidecar = load_sidecar(get_feature_table_path(data_path, split))
+        missing = [f for f in self.features_requested if f not in sidecar["features"]]
+        if missing:
+            raise ValueError("The feature table of %s in %s has no values for %s"
+                             % (split, str(data_path), ", ".join(missing)))
+        feature_bins = get_feature_bins()
+        table = np.zeros((len(sidecar["bins"]), len(self.features_requested)), dtype=np.int64)
+        for j, f in enumerate(self.features_requested):
+            symbol_ids = np.array([self.src_dict.index(get_control_token(f, value)) for value in feature_bins[f]],
+                                  dtype=np.int64)
+            table[:, j] = symbol_ids[sidecar["bins"][:, sidecar["features"].index(f)]]
+        return table
+
+    def load_dataset(self, split, epoch=1, combine=False, **kwargs):
+        paths = utils.split_paths(self.cfg.data)
+        assert len(paths) > 0
+        if split != self.cfg.train_subset:
+            paths = paths[:1]
+        data_path = paths[(epoch - 1) % len(paths)]
+
+        # load without length buckets and padding to a multiple, both depend on the length with the control tokens
+        pair_dataset = load_langpair_dataset(
+            data_path, split, self.cfg.source_lang, self.src_dict, self.cfg.target_lang, self.tgt_dict,
+            combine=combine, dataset_impl=self.cfg.dataset_impl, upsample_primary=self.cfg.upsample_primary,
+            left_pad_source=self.cfg.left_pad_source, left_pad_target=self.cfg.left_pad_target,
+            max_source_positions=self.cfg.max_source_positions, max_target_positions=self.cfg.max_target_positions,
+            load_alignments=self.cfg.load_alignments, truncate_source=self.cfg.truncate_source,
+            num_buckets=0, shuffle=(split != "test"), pad_to_multiple=1)
+
+        src_dataset = ControlTokenDataset(pair_dataset.src, self.control_token_table(data_path, split))
+        self.datasets[split] = LanguagePairDataset(
+            src_dataset, src_dataset.sizes, self.src_dict, pair_dataset.tgt, pair_dataset.tgt_sizes, self.tgt_dict,
+            left_pad_source=self.cfg.left_pad_source, left_pad_target=self.cfg.left_pad_target,
+            align_dataset=pair_dataset.align_dataset, eos=pair_dataset.eos,
+            num_buckets=self.cfg.num_batch_buckets, shuffle=(split != "test"),
+            pad_to_multiple=self.cfg.required_seq_len_multiple)
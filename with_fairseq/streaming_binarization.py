@@ -0,0 +1,111 @@
+"""
+fairseq mmap datasets written by preprocess.py --binarize while the corpus is preprocessed
+
+fairseq-preprocess reads the preprocessed text again to build the dictionaries and to binarize it. Here the token ids
+of every chunk are appended to [split].src-tgt.src.bin and [split].src-tgt.tgt.bin as soon as the chunk is
+preprocessed, the .idx files (the line lengths) are written when the split is done. The datasets are in the same
+format as the ones of fairseq-preprocess --dataset-impl mmap, training and generation memory-map them.
+
+As in fairseq-preprocess, the dictionaries dict.src.txt and dict.tgt.txt are built from the train split, the splits
+valid and test are encoded with them (unknown tokens become <unk>). The ids are given in the order the tokens first
+appear instead of sorted by count, the ids of the lines already written never change.
+"""
+
+import os
+from pathlib import Path
+import numpy as np
+from fairseq.data import Dictionary
+from fairseq.data.indexed_dataset import MMapIndexedDataset
+from fairseq.tokenizer import tokenize_line
+from utils.paths import get_binarized_dataset_prefix, suffixes
+from utils.preprocessing_journal import get_partial_path
+
+# the vocabulary is not known while the train split is written, int32 holds every id
+DATASET_DTYPE = np.int32
+REPLAY_BATCH_SIZE = 10000
+
+
+def get_dictionary_path(fairseq_dir, suffix):
+    return Path(fairseq_dir) / ("dict." + suffix + ".txt")
+
+
+def new_dictionaries():
+    return {suffix: Dictionary() for suffix in suffixes}
+
+
+def load_dictionaries(fairseq_dir):
+    """ The dictionaries of the train split, for binarizing valid and test """
+    paths = {suffix: get_dictionary_path(fairseq_dir, suffix) for suffix in suffixes}
+    missing = [str(path) for path in paths.values() if not path.exists()]
+    if missing:
+        raise FileNotFoundError("%s not found, binarize the train split first" % ", ".join(missing))
+    return {suffix: Dictionary.load(str(path)) for suffix, path in paths.items()}
+
+
+def save_dictionaries(fairseq_dir, dictionaries, padding_factor=8):
+    """ Pad the dictionaries to a multiple of padding_factor like fairseq-preprocess and save them """
+    for suffix, dictionary in dictionaries.items():
+        dictionary.pad_to_multiple_(padding_factor)
+        path = get_dictionary_path(fairseq_dir, suffix)
+        dictionary.save(str(get_partial_path(path)))
+        os.replace(get_partial_path(path), path)
+
+
+def encode_lines(dictionary, lines, add_symbols=False):
+    """ Return the token ids of all lines as one array (every line ends with eos) and the number of ids per line.
+    add_symbols: add unknown tokens to the dictionary and count every token (train split), else map them to <unk> """
+    ids, sizes = [], []
+    eos, unk, indices = dictionary.eos(), dictionary.unk(), dictionary.indices
+    for line in lines:
+        if add_symbols:
+            line_ids = [dictionary.add_symbol(word) for word in tokenize_line(line)]
+        else:
+            line_ids = [indices.get(word, unk) for word in tokenize_line(line)]
+        line_ids.append(eos)
+        ids.extend(line_ids)
+        sizes.append(len(line_ids))
+    return np.array(ids, dtype=DATASET_DTYPE), sizes
+
+
+class SplitBinarizer:
+    """
+    Writes the src and tgt lines of a split into the mmap datasets of fairseq_dir. The .bin files are temp files
+    until finish() writes the .idx files and renames both. Nothing of the binarized datasets is journaled: a resumed
+    run replays the committed lines of the preprocessed text with replay().
+    """
+    def __init__(self, fairseq_dir, split, dictionaries, add_symbols=False):
+        self.dictionaries = dictionaries
+        self.add_symbols = add_symbols
+        self.prefixes = {suffix: get_binarized_dataset_prefix(fairseq_dir, split, suffix) for suffix in suffixes}
+        Path(fairseq_dir).mkdir(parents=True, exist_ok=True)
+        self.data_files = {suffix: open(get_partial_path(str(prefix) + ".bin"), "wb")
+                           for suffix, prefix in self.prefixes.items()}
+        self.sizes = {suffix: [] for suffix in suffixes}
+
+    def add(self, suffix, lines):
+        """ Append the lines (strings, a trailing line break is ignored) to the dataset of suffix """
+        ids, sizes = encode_lines(self.dictionaries[suffix], lines, self.add_symbols)
+        self.data_files[suffix].write(ids.tobytes(order="C"))
+        self.sizes[suffix].extend(sizes)
+
+    def replay(self, suffix, text_path):
+        """ Add the lines of a preprocessed text file, e.g. the committed part of the temp file of a resumed split """
+        with open(text_path, "r", encoding="utf-8") as f:
+            batch = []
+            for line in f:
+                batch.append(line)
+                if len(batch) == REPLAY_BATCH_SIZE:
+                    self.add(suffix, batch)
+                    batch = []
+            if batch:
+                self.add(suffix, batch)
+
+    def finish(self):
+        """ Write the index files and move the datasets to their final names """
+        for suffix, prefix in self.prefixes.items():
+            self.data_files[suffix].close()
+            index_path = str(prefix) + ".idx"
+            with MMapIndexedDataset.Index.writer(str(get_partial_path(index_path)), DATASET_DTYPE) as index:
+                index.write(self.sizes[suffix])
+            os.replace(get_partial_path(str(prefix) + ".bin"), str(prefix) + ".bin")
+            os.replace(get_partial_path(index_path), index_path)